@@ -0,0 +1,49 @@
+'''
+Benchmark decoding of connector stdout lines: `AirbyteMessage.parse_raw` vs `bigloader.messages.decode_message`
+
+Usage: python -m benchmarks.decode [RECORDS] [FIELDS]
+'''
+import sys
+import json
+import time
+
+import airbyte_cdk.models
+
+from bigloader.messages import decode_message
+
+
+def generate_lines(records, fields):
+    data = {f'field_{k}': f'value {k}' if k % 2 else k for k in range(fields)}
+    message = airbyte_cdk.models.AirbyteMessage(
+        type=airbyte_cdk.models.Type.RECORD,
+        record=airbyte_cdk.models.AirbyteRecordMessage(stream='stream', data=data, emitted_at=1672531200000),
+    )
+    line = (message.json(exclude_unset=True) + '\n').encode('utf-8')
+    return [line] * records
+
+
+def parse_raw(line):
+    message = airbyte_cdk.models.AirbyteMessage.parse_raw(line)
+    return message.record.stream, json.dumps(message.record.data)
+
+
+def fast_decode(line):
+    message = decode_message(line)
+    return message.record.stream, message.record.data_json
+
+
+def benchmark(name, function, lines):
+    start = time.perf_counter()
+    for line in lines:
+        function(line)
+    duration = time.perf_counter() - start
+    print(f'{name:<12} {len(lines) / duration:>12,.0f} records/s')
+
+
+if __name__ == '__main__':
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    fields = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    lines = generate_lines(records, fields)
+    print(f'{records} records with {fields} fields ({len(lines[0])} bytes per line)')
+    benchmark('parse_raw', parse_raw, lines)
+    benchmark('fast decode', fast_decode, lines)
@@ -0,0 +1,148 @@
+'''
+Benchmark `bigloader run` end to end: the synthetic connector (benchmarks/synthetic_source.py) is run through
+`sources.AirbyteSource` and its messages are written by each destination, BigQuery being replaced by
+an in-memory fake client (benchmarks/fake_bigquery.py).
+
+Each destination runs in its own process to measure records/s, wall time and peak RSS of bigloader
+(not of the connector: its peak RSS would include the bigloader process it is forked from).
+Results are compared with `benchmarks/baseline.json` (run with `--save-baseline` to update it)
+and the command fails if records/s dropped by more than `--tolerance`.
+
+Usage: python -m benchmarks.end_to_end [--records N] [--streams N] [--record-size BYTES] [--interleave round_robin] [--destinations print,localjson,bigquery]
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import contextlib
+
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = f'{BENCHMARKS_FOLDER}/baseline.json'
+CONNECTOR_NAME = 'source-bigloader-benchmark'
+DESTINATIONS = {
+    'print': 'print()',
+    'localjson': 'localjson(output)',
+    'bigquery': 'bigquery(benchmark)',
+    'bigquery_load': 'bigquery_load(benchmark)',
+}
+SCENARIO_ARGS = ['records', 'streams', 'record_size', 'interleave', 'state_every', 'log_every', 'insert_latency']
+
+
+def get_peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if platform.system() == 'Darwin' else rss / 1024
+
+
+def install_connector(workdir, scenario):
+    from bigloader.sources import AIRBYTE_CONNECTORS_FOLDER, VIRTUAL_ENVS_FOLDER, PYTHON_FOLDER
+    connector_folder = f'{workdir}/{AIRBYTE_CONNECTORS_FOLDER}/{CONNECTOR_NAME}'
+    os.makedirs(connector_folder)
+    shutil.copy(f'{BENCHMARKS_FOLDER}/synthetic_source.py', f'{connector_folder}/main.py')
+    config = {name: scenario[name] for name in SCENARIO_ARGS if name != 'insert_latency'}
+    with open(f'{connector_folder}/bigloader_config.yaml', 'w', encoding='utf-8') as f:
+        json.dump({'configuration': config}, f)  # json is valid yaml
+    python_folder = f'{workdir}/{VIRTUAL_ENVS_FOLDER}/{CONNECTOR_NAME}/{PYTHON_FOLDER}'
+    os.makedirs(python_folder)
+    os.symlink(sys.executable, f'{python_folder}/python')
+
+
+def run_destination(destination, insert_latency):
+    from benchmarks import fake_bigquery
+    fake_bigquery.patch_bigquery_client(insert_latency=insert_latency)
+    from bigloader import destinations
+    from bigloader.sources import AirbyteSource
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        source = AirbyteSource(CONNECTOR_NAME)
+        catalog = source.configured_catalog
+        started_at = time.perf_counter()
+        destination = destinations.create_destination(DESTINATIONS[destination], catalog)
+        destination.run(source.read(catalog, print_log=False))
+        wall_seconds = time.perf_counter() - started_at
+    return {
+        'wall_seconds': round(wall_seconds, 3),
+        'peak_rss_mb': round(get_peak_rss_mb(), 1),
+    }
+
+
+def run_scenario(scenario, destinations):
+    results = {}
+    repo_folder = os.path.dirname(BENCHMARKS_FOLDER)
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [repo_folder, os.environ.get('PYTHONPATH')]))}
+    with tempfile.TemporaryDirectory() as workdir:
+        install_connector(workdir, scenario)
+        for destination in destinations:
+            command = [
+                sys.executable, '-m', 'benchmarks.end_to_end',
+                '--run-destination', destination,
+                '--insert-latency', str(scenario['insert_latency']),
+            ]
+            output = subprocess.run(command, cwd=workdir, env=env, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            result['records_per_second'] = round(scenario['records'] / result['wall_seconds'])
+            results[destination] = result
+            shutil.rmtree(f'{workdir}/output', ignore_errors=True)
+    return results
+
+
+def compare_with_baseline(scenario, results, tolerance):
+    if not os.path.exists(BASELINE_FILE):
+        print(f'No baseline found at {BASELINE_FILE}. Create one with --save-baseline')
+        return True
+    baseline = json.load(open(BASELINE_FILE, encoding='utf-8'))
+    if baseline['scenario'] != scenario:
+        print(f'Baseline was measured with another scenario: {baseline["scenario"]}')
+        return True
+    ok = True
+    for destination, result in results.items():
+        if destination not in baseline['results']:
+            continue
+        reference = baseline['results'][destination]['records_per_second']
+        ratio = result['records_per_second'] / reference
+        regression = ratio < 1 - tolerance
+        ok = ok and not regression
+        print(f'{destination:<14} {ratio:>6.2f}x baseline ({reference:,} records/s){"  REGRESSION" if regression else ""}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.end_to_end', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--records', type=int, default=200000)
+    parser.add_argument('--streams', type=int, default=4)
+    parser.add_argument('--record-size', type=int, default=200)
+    parser.add_argument('--interleave', default='round_robin', choices=['sequential', 'round_robin', 'random'])
+    parser.add_argument('--state-every', type=int, default=10000)
+    parser.add_argument('--log-every', type=int, default=10000)
+    parser.add_argument('--insert-latency', type=float, default=0, help='seconds taken by each fake BigQuery insert request')
+    parser.add_argument('--destinations', default='print,localjson,bigquery')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='accepted records/s drop versus baseline')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--run-destination', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_destination:
+        print(json.dumps(run_destination(args.run_destination, args.insert_latency)))
+        return
+
+    scenario = {name: getattr(args, name) for name in SCENARIO_ARGS}
+    print(f'Scenario: {scenario}')
+    results = run_scenario(scenario, args.destinations.split(','))
+    print(f'{"destination":<14} {"records/s":>12} {"wall (s)":>10} {"peak RSS (MB)":>14}')
+    for destination, result in results.items():
+        print(f'{destination:<14} {result["records_per_second"]:>12,} {result["wall_seconds"]:>10} {result["peak_rss_mb"]:>14}')
+    if args.save_baseline:
+        with open(BASELINE_FILE, 'w', encoding='utf-8') as f:
+            json.dump({'scenario': scenario, 'platform': platform.platform(), 'results': results}, f, indent=4)
+        print(f'Baseline saved into {BASELINE_FILE}')
+    elif not compare_with_baseline(scenario, results, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+'''
+In-memory stand-in for `google.cloud.bigquery.Client`, enough to run bigloader BigQuery destinations offline.
+Rows are serialized as the real client does but only counted, not kept, except states:
+the state merged into `_airbyte_latest_state` tables and the last row inserted into `_airbyte_states` tables
+are kept and served back to state queries.
+'''
+import re
+import json
+import time
+import threading
+import collections
+
+
+class FakeRow:
+
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+class FakeQueryJob:
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+
+    def result(self):
+        return self.rows
+
+
+class FakeTable:
+
+    def __init__(self, table_id):
+        self.table_id = table_id
+        self.schema = []
+
+
+class FakeBigQueryClient:
+
+    project = 'benchmark'
+    insert_latency = 0
+    tables = set()
+    rows = collections.Counter()
+    bytes = collections.Counter()
+    states = {}
+    lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @classmethod
+    def reset(cls):
+        cls.tables.clear()
+        cls.rows.clear()
+        cls.bytes.clear()
+        cls.states.clear()
+
+    def query(self, query, job_config=None, **kwargs):
+        parameters = {parameter.name: parameter.value for parameter in getattr(job_config, 'query_parameters', [])}
+        with self.lock:
+            self.tables.update(re.findall(r'create table if not exists `[^.`]+\.([^`]+)`', query))
+            merged_table = re.search(r'merge `([^`]+_airbyte_latest_state)`', query)
+            if merged_table:
+                self.states[merged_table.group(1)] = parameters['state']
+                return FakeQueryJob()
+            selected_table = re.search(r"select json_extract\(_airbyte_data, '\$\.data'\) as state\s+from `([^`]+)`", query)
+            if selected_table and selected_table.group(1) in self.states:
+                state = json.loads(self.states[selected_table.group(1)])['data']
+                return FakeQueryJob([FakeRow(state=json.dumps(state))])
+        return FakeQueryJob()
+
+    def list_tables(self, dataset):
+        return [FakeTable(table) for table in sorted(self.tables)]
+
+    def get_table(self, table):
+        return FakeTable(table.split('.')[-1])
+
+    def insert_rows_json(self, table, rows, **kwargs):
+        size = len(json.dumps(rows))
+        time.sleep(self.insert_latency)
+        with self.lock:
+            self.rows[table] += len(rows)
+            self.bytes[table] += size
+            if table.endswith('_airbyte_states') and rows:
+                self.states[table] = rows[-1]['_airbyte_data']
+        return []
+
+    def load_table_from_file(self, file, table, job_config=None, **kwargs):
+        import gzip
+        content = gzip.decompress(file.read())
+        time.sleep(self.insert_latency)
+        with self.lock:
+            self.rows[table] += content.count(b'\n')
+            self.bytes[table] += len(content)
+        return FakeQueryJob()
+
+
+def patch_bigquery_client(insert_latency=0):
+    '''
+    Replace `google.cloud.bigquery.Client` by `FakeBigQueryClient` whose inserts take `insert_latency` seconds.
+    '''
+    import google.cloud.bigquery
+    FakeBigQueryClient.insert_latency = insert_latency
+    google.cloud.bigquery.Client = FakeBigQueryClient
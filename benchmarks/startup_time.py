@@ -0,0 +1,79 @@
+'''
+Benchmark `bigloader` CLI startup: `bigloader --help` is run with `python -X importtime` and the cumulative import time
+of `bigloader.cli` (best of `--runs`) is compared with `--budget`.
+The command fails if it is over budget or if a heavy module (only needed to run connectors or destinations)
+is imported at startup.
+
+Usage: python -m benchmarks.startup_time [--budget MS] [--runs N] [--top N]
+'''
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+CLI_MODULE = 'bigloader.cli'
+COMMAND = 'import sys; sys.argv = ["bigloader", "--help"]; from bigloader.cli import cli; cli()'
+HEAVY_MODULES = ['airbyte_cdk', 'pydantic', 'jinja2', 'yaml', 'google.cloud', 'pyarrow', 'bigloader.messages', 'bigloader.metrics']
+
+
+def parse_importtime(output):
+    '''
+    Return `{module: (self_us, cumulative_us)}` from `python -X importtime` stderr `output`.
+    '''
+    imports = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        imports[module.strip()] = (int(self_us), int(cumulative_us))
+    return imports
+
+
+def run_cli():
+    repo_folder = os.path.dirname(BENCHMARKS_FOLDER)
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [repo_folder, os.environ.get('PYTHONPATH')]))}
+    started_at = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', COMMAND], env=env, capture_output=True, text=True)
+    wall_seconds = time.perf_counter() - started_at
+    if result.returncode != 0:
+        sys.exit(f'`bigloader --help` failed:\n{result.stderr}')
+    return parse_importtime(result.stderr), wall_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.startup_time', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--budget', type=float, default=150, help='maximum import time of bigloader.cli in milliseconds')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='number of slowest imports to show')
+    args = parser.parse_args()
+
+    runs = [run_cli() for _ in range(args.runs)]
+    imports = min((run[0] for run in runs), key=lambda imports: imports[CLI_MODULE][1])
+    import_ms = imports[CLI_MODULE][1] / 1000
+    print(f'`bigloader --help` wall time (best of {args.runs}): {min(run[1] for run in runs) * 1000:.1f} ms')
+    print(f'{CLI_MODULE} import time (best of {args.runs}): {import_ms:.1f} ms (budget: {args.budget:g} ms)')
+    print('\nSlowest imports (cumulative):')
+    slowest = sorted(imports.items(), key=lambda item: item[1][1], reverse=True)[:args.top]
+    for module, (_, cumulative_us) in slowest:
+        print(f'{cumulative_us / 1000:>10.1f} ms  {module}')
+
+    ok = True
+    heavy_modules = [
+        heavy for heavy in HEAVY_MODULES
+        if any(module == heavy or module.startswith(f'{heavy}.') for module in imports)
+    ]
+    if heavy_modules:
+        ok = False
+        print(f'\nHEAVY MODULES IMPORTED AT STARTUP: {", ".join(heavy_modules)}')
+    if import_ms > args.budget:
+        ok = False
+        print(f'\nOVER BUDGET: {import_ms:.1f} ms > {args.budget:g} ms')
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
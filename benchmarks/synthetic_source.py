@@ -0,0 +1,111 @@
+'''
+Synthetic airbyte source connector used by benchmarks. It only depends on the standard library.
+
+Configuration:
+- `records`: number of records emitted (all streams together). When the configured catalog only lists some streams,
+  only their records are emitted (so a `--parallel` read still gets `records` records in total)
+- `streams`: number of streams (`stream_0`, `stream_1`, ...)
+- `record_size`: approximate size in bytes of each record data
+- `interleave`: order of records of the streams: `sequential` (streams one after the other),
+  `round_robin` (one record of each stream in turn) or `random`
+- `state_every`: a STATE message is emitted every `state_every` records
+- `log_every`: a LOG message is emitted every `log_every` records (0 to disable)
+'''
+import sys
+import json
+import random
+
+
+SPEC = {
+    'documentationUrl': 'https://github.com/unytics/bigloader',
+    'connectionSpecification': {
+        'type': 'object',
+        'properties': {
+            'records': {'type': 'integer', 'default': 100000},
+            'streams': {'type': 'integer', 'default': 4},
+            'record_size': {'type': 'integer', 'default': 200},
+            'interleave': {'type': 'string', 'enum': ['sequential', 'round_robin', 'random'], 'default': 'round_robin'},
+            'state_every': {'type': 'integer', 'default': 10000},
+            'log_every': {'type': 'integer', 'default': 10000},
+        },
+    },
+}
+
+
+def get_arg(name):
+    return sys.argv[sys.argv.index(name) + 1] if name in sys.argv else None
+
+
+def get_streams_order(config):
+    records, streams = config['records'], config['streams']
+    if config['interleave'] == 'sequential':
+        return (k * streams // records for k in range(records))
+    if config['interleave'] == 'random':
+        generator = random.Random(0)
+        return (generator.randrange(streams) for _ in range(records))
+    return (k % streams for k in range(records))
+
+
+def read(config, catalog, state):
+    write = sys.stdout.write
+    streams = [f'stream_{k}' for k in range(config['streams'])]
+    selected_streams = {configured_stream['stream']['name'] for configured_stream in catalog['streams']}
+    cursors = {stream: state.get(stream, {}).get('cursor', 0) for stream in streams if stream in selected_streams}
+    payload = 'x' * max(config['record_size'] - 60, 0)
+    state_every, log_every = config['state_every'], config['log_every']
+    k = 0
+    for stream_index in get_streams_order(config):
+        stream = streams[stream_index]
+        if stream not in cursors:
+            continue
+        k += 1
+        cursors[stream] += 1
+        data = {'id': cursors[stream], 'updated_at': '2023-01-01T00:00:00Z', 'payload': payload}
+        write(json.dumps({'type': 'RECORD', 'record': {'stream': stream, 'data': data, 'emitted_at': 1672531200000}}) + '\n')
+        if log_every and k % log_every == 0:
+            write(json.dumps({'type': 'LOG', 'log': {'level': 'INFO', 'message': f'Read {k} records'}}) + '\n')
+        if state_every and k % state_every == 0:
+            write(json.dumps({'type': 'STATE', 'state': {'data': {s: {'cursor': c} for s, c in cursors.items()}}}) + '\n')
+    write(json.dumps({'type': 'STATE', 'state': {'data': {s: {'cursor': c} for s, c in cursors.items()}}}) + '\n')
+
+
+def main():
+    command = sys.argv[1]
+    if command == 'spec':
+        print(json.dumps({'type': 'SPEC', 'spec': SPEC}))
+        return
+    config = {
+        name: value.get('default')
+        for name, value in SPEC['connectionSpecification']['properties'].items()
+    }
+    config.update(json.load(open(get_arg('--config'))))
+    if command == 'check':
+        print(json.dumps({'type': 'CONNECTION_STATUS', 'connectionStatus': {'status': 'SUCCEEDED'}}))
+    elif command == 'discover':
+        streams = [
+            {
+                'name': f'stream_{k}',
+                'json_schema': {
+                    'type': 'object',
+                    'properties': {
+                        'id': {'type': 'integer'},
+                        'updated_at': {'type': 'string', 'format': 'date-time'},
+                        'payload': {'type': 'string'},
+                    },
+                },
+                'supported_sync_modes': ['full_refresh', 'incremental'],
+                'source_defined_cursor': True,
+                'default_cursor_field': ['id'],
+                'source_defined_primary_key': [['id']],
+            }
+            for k in range(config['streams'])
+        ]
+        print(json.dumps({'type': 'CATALOG', 'catalog': {'streams': streams}}))
+    elif command == 'read':
+        catalog = json.load(open(get_arg('--catalog')))
+        state = json.load(open(get_arg('--state'))) if get_arg('--state') else {}
+        read(config, catalog, state)
+
+
+if __name__ == '__main__':
+    main()
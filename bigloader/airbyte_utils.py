@@ -6,12 +6,11 @@
 #  - https://github.com/airbytehq/airbyte/blob/master/octavia-cli/octavia_cli/generate/templates/source_or_destination.yaml.j2
 #
 
+import functools
 from typing import Any, Callable, List
 
-import jinja2
 
-
-TEMPLATE = jinja2.Template('''
+TEMPLATE = '''
 # Documentation to configure this connector can be found at {{ documentation_url }}
 {%- macro render_field(field, is_commented) %}
 {%- if is_commented %}# {% endif %}{{ field.name }}:{% if field.default %} {% if field.airbyte_secret %}{{ field.default }}{% else %}{{ field.default | tojson() }}{% endif %}{% endif %} # {{ field.comment }}
@@ -83,7 +82,13 @@ configuration:
 {{- render_root(root, is_commented=True)}}
 {%- endif %}
 {% endfor %}
-''', autoescape=jinja2.select_autoescape(), trim_blocks=False, lstrip_blocks=True)
+'''
+
+
+@functools.lru_cache()
+def get_template():
+    import jinja2
+    return jinja2.Template(TEMPLATE, autoescape=jinja2.select_autoescape(), trim_blocks=False, lstrip_blocks=True)
 
 
 class FieldToRender:
@@ -219,7 +224,7 @@ def parse_connection_specification(schema: dict) -> List[List["FieldToRender"]]:
 
 def generate_connection_yaml_config_sample(source_spec):
     parsed_schema = parse_connection_specification(source_spec['connectionSpecification'])
-    return TEMPLATE.render({
+    return get_template().render({
         "documentation_url": source_spec['documentationUrl'],
         "configuration_fields": parsed_schema,
     })
@@ -1,8 +1,11 @@
+import os
+
 import click
 import click_help_colors
 
 from . import sources, destinations
 from .sources import AirbyteSource
+from .profiler import Profiler, merge_profiles, get_profiles_prefixes
 
 
 @click.group(
@@ -37,26 +40,42 @@ def get(airbyte_connector, airbyte_release):
 
 @cli.command()
 @click.argument('airbyte_connector')
-def install(airbyte_connector):
+@click.option('--wheelhouse', 'wheelhouses', multiple=True, help='Folder of wheels where packages are looked for first (can be repeated)')
+@click.option('--offline', is_flag=True, help='Install packages only from the wheel cache and `--wheelhouse` folders, without package index')
+def install(airbyte_connector, wheelhouses, offline):
     '''
-    Install local `airbyte_connector` located at `airbyte_connectors/{airbyte_connector}` with pip
+    Install local `airbyte_connector` located at `airbyte_connectors/{airbyte_connector}` with pip.
+
+    Its dependencies are installed from a local wheel cache into a virtual env shared by connectors with the same dependencies.
     '''
     source = AirbyteSource(airbyte_connector)
-    source.install()
+    source.install(wheelhouses=wheelhouses, offline=offline)
     source.init_config()
 
 
-def add_destinations_doc(function):
-    destinations_doc = '\n    '.join([f'• {destination.get_init_help()}' for destination in destinations.DESTINATIONS.values()])
-    function.__doc__ = function.__doc__.format(ACCEPTED_DESTINATIONS=destinations_doc)
-    return function
+class DestinationsDocCommand(click_help_colors.HelpColorsCommand):
+    '''
+    Command whose help `{ACCEPTED_DESTINATIONS}` is replaced by destinations doc only when the help is shown
+    '''
+
+    def format_help_text(self, ctx, formatter):
+        if '{ACCEPTED_DESTINATIONS}' in self.help:
+            destinations_doc = '\n    '.join([f'• {destination.get_init_help()}' for destination in destinations.DESTINATIONS.values()])
+            self.help = self.help.format(ACCEPTED_DESTINATIONS=destinations_doc)
+        super().format_help_text(ctx, formatter)
 
 
-@cli.command()
+@cli.command(cls=DestinationsDocCommand)
 @click.argument('airbyte_connector')
 @click.option('--destination', default='print()', help='extracted data destination')
-@add_destinations_doc
-def run(airbyte_connector, destination):
+@click.option('--refresh-catalog', is_flag=True, help='Ignore cached connector spec and catalog and discover them again')
+@click.option('--parallel', default=1, type=click.IntRange(min=1), help='Number of connector processes reading streams in parallel')
+@click.option('--sync-mode', default='append', type=click.Choice(['append', 'append_dedup']), help='`append_dedup` merges records of streams with a primary key into deduplicated tables (BigQuery destinations only)')
+@click.option('--metrics', 'metrics_file', help='Write a json summary of job metrics (records, bytes, parse time, waits, flush latencies per stream) into this file')
+@click.option('--prometheus-file', help='Also write job metrics in Prometheus text format into this file every 10 seconds (requires `--metrics`)')
+@click.option('--profile', 'profile_folder', help='Profile bigloader and connector processes and write flame graph compatible folded stacks and peak memory into this folder')
+@click.option('--in-process', is_flag=True, help='Import and run the connector from its virtual env in bigloader process instead of a subprocess (connector uses bigloader airbyte-cdk version, not compatible with `--parallel`)')
+def run(airbyte_connector, destination, refresh_catalog, parallel, sync_mode, metrics_file, prometheus_file, profile_folder, in_process):
     '''
     Run `airbyte_connector` extract job
 
@@ -67,12 +86,47 @@ def run(airbyte_connector, destination):
     {ACCEPTED_DESTINATIONS}
 
     (PLEASE replace uppercase variables such as FOLDER with values in the above destinations)
+
+    Optional destination arguments are positional and empty arguments are ignored:
+    use `none` (compression) or `0` (limits) as placeholders to skip one,
+    e.g. `localjson(FOLDER, none, 0, 100000)` for parts of 100000 records without compression.
     '''
-    source = AirbyteSource(airbyte_connector)
-    catalog = source.configured_catalog
-    destination = destinations.create_destination(destination, catalog)
-    messages = source.run('read', catalog=catalog, print_log=False)
-    destination.run(messages)
+    if prometheus_file and not metrics_file:
+        raise click.UsageError('`--prometheus-file` requires `--metrics`')
+    if in_process and parallel > 1:
+        raise click.UsageError('`--in-process` cannot be used with `--parallel`: connector logs and source instance would be shared by reader threads')
+    if profile_folder:
+        os.makedirs(profile_folder, exist_ok=True)
+        profiler = Profiler(f'{profile_folder}/bigloader')
+        profiler.start()
+    source = AirbyteSource(airbyte_connector, refresh_catalog=refresh_catalog, profile_folder=profile_folder, in_process=in_process)
+    try:
+        catalog = source.get_configured_catalog(destination_sync_mode=sync_mode)
+        try:
+            destination = destinations.create_destination(destination, catalog)
+        except ValueError as e:
+            raise click.UsageError(f'Invalid `--destination`: {e}')
+        run_extract_load(source, catalog, destination, parallel, metrics_file, prometheus_file)
+    finally:
+        if profile_folder:
+            profiler.stop()
+            merge_profiles(f'{profile_folder}/connector', get_profiles_prefixes(profile_folder, source.profile_name))
+
+
+def run_extract_load(source, catalog, destination, parallel, metrics_file, prometheus_file):
+    state = destination.get_state()
+    if not metrics_file:
+        messages = source.read(catalog, state=state, print_log=False, parallel=parallel)
+        destination.run(messages)
+        return
+    from .metrics import Metrics
+    metrics = Metrics(metrics_file, prometheus_file=prometheus_file)
+    destination.metrics = metrics
+    try:
+        messages = source.read(catalog, state=state, print_log=False, parallel=parallel, metrics=metrics)
+        destination.run(metrics.track_messages(messages))
+    finally:
+        metrics.close()
 
 
 
@@ -1,13 +1,113 @@
 import os
+import re
 import json
 import inspect
 import datetime
 import uuid
-
-import airbyte_cdk
-
-from .utils import print_info
-
+import collections
+import concurrent.futures
+import tempfile
+import gzip
+import time
+import threading
+
+from .file_writer import RecordsFileWriter, COMPRESSIONS_EXTENSIONS
+from .log_sink import LogSink
+from .parquet_writer import ParquetFileWriter
+from .json_schema import get_column_kind, split_record, UNPARSED_COLUMN
+from .utils import print_info, read_json, write_file_atomically, write_json_atomically, CACHE_FOLDER
+
+
+ROW_OVERHEAD_BYTES = 200  # approximate size of `_airbyte_*` metadata columns in an insert request
+BIGQUERY_TABLES_CACHE_FILE = f'{CACHE_FOLDER}/bigquery_tables.json'
+CREATE_TABLE_QUERY = '''
+    create table if not exists `{dataset}.{table}` (
+        _airbyte_ab_id string options(description="Record uuid generated at insertion into BigQuery"),
+        _airbyte_job_started_at timestamp options(description="Extract-load job start timestamp"),
+        _airbyte_slice_started_at timestamp options(description="When incremental mode is used, data records are emitted by chunks a.k.a. slices. At the end of each slice, a state record is emitted to store a checkpoint. This column stores the timestamp when the slice started"),
+        _airbyte_emitted_at timestamp options(description="Record ingestion time into BigQuery"),
+        _airbyte_data string options(description="Record data as json string")
+    )
+    partition by date(_airbyte_emitted_at)
+    options(
+        description="{table} records ingested by bigloader"
+    )
+'''
+CREATE_TABLE_QUERIES = {
+    '_airbyte_latest_state': '''
+        create table if not exists `{dataset}.{table}` (
+            state_key string options(description="State identifier"),
+            _airbyte_emitted_at timestamp options(description="State ingestion time into BigQuery"),
+            _airbyte_data string options(description="Latest state message as json string")
+        )
+        options(
+            description="Latest state ingested by bigloader, updated with MERGE at each checkpoint"
+        )
+    ''',
+}
+LATEST_STATE_KEY = 'latest'
+CREATE_DEDUP_TABLE_QUERY = '''
+    create table if not exists `{dataset}.{table}` (
+        _airbyte_primary_key string options(description="Record primary key as json string"),
+        _airbyte_ab_id string options(description="Record uuid generated at insertion into BigQuery"),
+        _airbyte_job_started_at timestamp options(description="Extract-load job start timestamp"),
+        _airbyte_slice_started_at timestamp options(description="When incremental mode is used, data records are emitted by chunks a.k.a. slices. At the end of each slice, a state record is emitted to store a checkpoint. This column stores the timestamp when the slice started"),
+        _airbyte_emitted_at timestamp options(description="Record ingestion time into BigQuery"),
+        _airbyte_data string options(description="Record data as json string")
+    )
+    cluster by _airbyte_primary_key
+    options(
+        description="Latest version of {stream} records by primary key, merged by bigloader from `{raw_table}` at each checkpoint"
+    )
+'''
+MERGE_DEDUP_TABLE_QUERY = '''
+    merge `{dataset}.{table}` final
+    using (
+        select * except(row_number)
+        from (
+            select
+                {primary_key} as _airbyte_primary_key,
+                _airbyte_ab_id, _airbyte_job_started_at, _airbyte_slice_started_at, _airbyte_emitted_at, _airbyte_data,
+                row_number() over (partition by {primary_key} order by _airbyte_emitted_at desc) as row_number
+            from `{dataset}.{raw_table}`
+            where _airbyte_emitted_at >= @merge_from
+        )
+        where row_number = 1
+    ) staging
+    on final._airbyte_primary_key = staging._airbyte_primary_key
+    when matched and staging._airbyte_emitted_at >= final._airbyte_emitted_at then
+        update set
+            _airbyte_ab_id = staging._airbyte_ab_id,
+            _airbyte_job_started_at = staging._airbyte_job_started_at,
+            _airbyte_slice_started_at = staging._airbyte_slice_started_at,
+            _airbyte_emitted_at = staging._airbyte_emitted_at,
+            _airbyte_data = staging._airbyte_data
+    when not matched then
+        insert (_airbyte_primary_key, _airbyte_ab_id, _airbyte_job_started_at, _airbyte_slice_started_at, _airbyte_emitted_at, _airbyte_data)
+        values (staging._airbyte_primary_key, staging._airbyte_ab_id, staging._airbyte_job_started_at, staging._airbyte_slice_started_at, staging._airbyte_emitted_at, staging._airbyte_data)
+'''
+CREATE_TYPED_TABLE_QUERY = '''
+    create table if not exists `{dataset}.{table}` (
+        _airbyte_ab_id string options(description="Record uuid generated at insertion into BigQuery"),
+        _airbyte_job_started_at timestamp options(description="Extract-load job start timestamp"),
+        _airbyte_slice_started_at timestamp options(description="When incremental mode is used, data records are emitted by chunks a.k.a. slices. At the end of each slice, a state record is emitted to store a checkpoint. This column stores the timestamp when the slice started"),
+        _airbyte_emitted_at timestamp options(description="Record ingestion time into BigQuery"),
+        {columns}
+        _airbyte_unparsed string options(description="Record fields missing from the stream json_schema or whose value does not match their column type, as json string")
+    )
+    partition by date(_airbyte_emitted_at)
+    options(
+        description="{table} records ingested by bigloader"
+    )
+'''
+BIGQUERY_COLUMN_TYPES = {'integer': 'INT64', 'number': 'FLOAT64', 'boolean': 'BOOL', 'string': 'STRING', 'json': 'JSON'}
+BIGQUERY_COLUMN_KINDS = {
+    'INTEGER': 'integer', 'INT64': 'integer',
+    'FLOAT': 'number', 'FLOAT64': 'number',
+    'BOOLEAN': 'boolean', 'BOOL': 'boolean',
+    'STRING': 'string',
+    'JSON': 'json',
+}
 
 
 def create_file_or_try_to_open(filename):
@@ -17,31 +117,130 @@ def create_file_or_try_to_open(filename):
         raise ValueError(f'Cannot create or open file {filename}')
 
 
-def get_latest_line_of_file(filename):
+def get_latest_line_of_file(filename, chunk_size=1024 * 1024):
+    '''
+    Return the last complete (newline terminated) line of `filename`, reading the file backwards by chunks.
+    A last line without newline (half-written during a crash) is ignored.
+    '''
     with open(filename, 'rb') as f:
-        try:  # catch OSError in case of a one line file
-            f.seek(-2, os.SEEK_END)
-            while f.read(1) != b'\n':
-                f.seek(-2, os.SEEK_CUR)
-        except OSError:
-            f.seek(0)
-        return f.readline().decode(encoding='utf-8')
+        position = f.seek(0, os.SEEK_END)
+        data = b''
+        is_line_end_found = False
+        while position > 0:
+            size = min(chunk_size, position)
+            position -= size
+            f.seek(position)
+            data = f.read(size) + data
+            if not is_line_end_found:
+                line_end = data.rfind(b'\n')
+                if line_end == -1:
+                    data = b''
+                    continue
+                data = data[:line_end]
+                is_line_end_found = True
+            line_start = data.rfind(b'\n')
+            if line_start != -1:
+                return data[line_start + 1:].decode(encoding='utf-8')
+        return data.decode(encoding='utf-8')
+
+
+def terminate_last_line_of_file(filename):
+    '''
+    Add a newline at the end of `filename` if its last line is incomplete (half-written during a crash)
+    so that the next appended line is not merged with it.
+    '''
+    with open(filename, 'rb+') as f:
+        if f.seek(0, os.SEEK_END) == 0:
+            return
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b'\n':
+            f.write(b'\n')
+
+
+def close_all(writers):
+    '''
+    Close all `writers` then raise the first error raised while closing them, if any.
+    '''
+    errors = []
+    for writer in writers:
+        try:
+            writer.close()
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+def get_value_at_path(data, path):
+    for key in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def deduplicate_rows(rows, primary_key):
+    '''
+    Keep the last of `rows` (json strings) with the same `primary_key` (list of paths), in the order of these last rows.
+    '''
+    rows_by_key = {}
+    for row in rows:
+        data = json.loads(row)
+        key = json.dumps([get_value_at_path(data, path) for path in primary_key])
+        rows_by_key.pop(key, None)
+        rows_by_key[key] = row
+    return list(rows_by_key.values())
+
+
+def get_json_path(path):
+    '''
+    Return JSONPath of `path` keys in bracket notation, with quotes and backslashes of keys escaped.
+    '''
+    return '$' + ''.join("['{}']".format(str(key).replace('\\', '\\\\').replace("'", "\\'")) for key in path)
+
+
+def get_bigquery_column_name(field):
+    column = re.sub(r'[^a-zA-Z0-9_]', '_', field)
+    return column if re.match(r'[a-zA-Z_]', column) else f'_{column}'
+
+
+def is_payload_too_large_error(error):
+    return getattr(error, 'code', None) == 413 or 'payload size exceeds' in str(error).lower()
+
+
+def is_not_found_error(error):
+    return getattr(error, 'code', None) == 404
 
 
 class BaseDestination:
 
+    metrics = None
+    batch_age_max = 1.0
+    batch_bytes_max = 1_000_000
+
     def __init__(self, catalog):
         self.catalog = catalog
         self.streams = [s['stream']['name'] for s in catalog['streams']]
 
     def get_state(self):
-        raise NotImplementedError()
+        return {}
 
     def get_logs(self):
         raise NotImplementedError()
 
     def run(self, messages):
-        raise NotImplementedError()
+        from .messages import batch_messages
+        self.run_batches(batch_messages(messages, batch_bytes_max=self.batch_bytes_max, batch_age_max=self.batch_age_max))
+
+    def run_batches(self, batches):
+        '''
+        Handle `RecordBatch` of serialized records and other airbyte messages.
+        Destinations implement either `run` or `run_batches`, the other one is adapted.
+        '''
+        if type(self).run is BaseDestination.run:
+            raise NotImplementedError()
+        from .messages import unbatch_messages
+        self.run(unbatch_messages(batches))
 
     @classmethod
     def get_class_name(cls):
@@ -67,149 +266,585 @@ class PrintDestination(BaseDestination):
 
 class LocalJsonDestination(BaseDestination):
 
-    def __init__(self, catalog, folder):
+    def __init__(self, catalog, folder, compression=None, part_size_max=None, part_records_max=None):
         super().__init__(catalog)
         os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.compression = compression if compression not in ['', 'none'] else None
+        if self.compression not in COMPRESSIONS_EXTENSIONS:
+            raise ValueError(f'Compression `{compression}` is not supported. Accepted values are none, gzip, zstd')
+        self.part_size_max = int(part_size_max) if part_size_max else None
+        self.part_records_max = int(part_records_max) if part_records_max else None
         self.states_file = f'{folder}/states.jsonl'
+        self.latest_state_file = f'{folder}/state.latest.json'
         self.logs_file = f'{folder}/logs.jsonl'
         self.stream_file = lambda stream: f'{folder}/{stream}.jsonl'
         create_file_or_try_to_open(self.states_file)
         create_file_or_try_to_open(self.logs_file)
-        for stream in self.streams:
-            create_file_or_try_to_open(self.stream_file(stream))
+        if not self.is_partitioned:
+            for stream in self.streams:
+                create_file_or_try_to_open(self.stream_file(stream))
+
+    @property
+    def is_partitioned(self):
+        return bool(self.compression or self.part_size_max or self.part_records_max)
+
+    def create_stream_writer(self, stream):
+        return RecordsFileWriter(self.folder, stream, self.compression, self.part_size_max, self.part_records_max)
 
     def get_state(self):
-        content = get_latest_line_of_file(self.states_file)
+        if os.path.exists(self.latest_state_file):
+            content = open(self.latest_state_file, encoding='utf-8').read()
+        else:
+            content = get_latest_line_of_file(self.states_file)
         if not content:
             return {}
         else:
             state = json.loads(content)
             return state['data']
 
-    def run(self, messages):
+    def run_batches(self, batches):
+        import airbyte_cdk.models
+        files = [self.states_file, self.logs_file]
+        if not self.is_partitioned:
+            files += [self.stream_file(stream) for stream in self.streams]
+        for filename in files:
+            terminate_last_line_of_file(filename)
         states_file = open(self.states_file, 'a', encoding='utf-8')
         logs_file = open(self.logs_file, 'a', encoding='utf-8')
-        streams_files = {
-            stream: open(self.stream_file(stream), 'a', encoding='utf-8')
-            for stream in self.streams
-        }
+        streams_writers = {stream: self.create_stream_writer(stream) for stream in self.streams}
         try:
-            for message in messages:
+            for message in batches:
                 if message.type == airbyte_cdk.models.Type.LOG:
                     message = message.log.json(exclude_unset=True)
                     print_info(message)
                     logs_file.write(message + '\n')
                 elif message.type == airbyte_cdk.models.Type.RECORD:
-                    file = streams_files[message.record.stream]
-                    row = json.dumps(message.record.data)
-                    file.write(row + '\n')
+                    streams_writers[message.stream].write(message.data, len(message), message.offsets)
                 elif message.type == airbyte_cdk.models.Type.STATE:
-                    states_file.write(message.state.json(exclude_unset=True) + '\n')
+                    for stream, stream_writer in streams_writers.items():
+                        sync_started_at = time.perf_counter()
+                        stream_writer.sync()
+                        if self.metrics:
+                            self.metrics.observe('sync_seconds', stream, time.perf_counter() - sync_started_at)
+                    state = message.state.json(exclude_unset=True)
+                    states_file.write(state + '\n')
+                    states_file.flush()
+                    write_file_atomically(state, self.latest_state_file)
         finally:
             states_file.close()
             logs_file.close()
-            for stream_file in streams_files.values():
-                stream_file.close()
+            close_all(streams_writers.values())
+
+
+class ParquetDestination(LocalJsonDestination):
+    '''
+    Same layout as LocalJsonDestination with partitioned files but records of each stream are written
+    into `{folder}/{stream}/part-00001.parquet` files with columns derived from the stream `json_schema`.
+    A row group is written every `row_group_size` records and each STATE closes the current parts
+    (before the state is saved) so that records of saved states are always readable.
+    '''
+
+    is_partitioned = True
+
+    def __init__(self, catalog, folder, row_group_size=100000):
+        super().__init__(catalog, folder)
+        self.row_group_size = int(row_group_size)
+        self.json_schemas = {s['stream']['name']: s['stream'].get('json_schema', {}) for s in catalog['streams']}
+
+    def create_stream_writer(self, stream):
+        return ParquetFileWriter(self.folder, stream, self.json_schemas[stream], row_group_size=self.row_group_size)
+
+
+class StreamBuffer:
+
+    def __init__(self, started_at=None):
+        self.rows = []
+        self.bytes = 0
+        self.started_at = started_at or time.monotonic()
 
 
 class BigQueryDestination(BaseDestination):
+    '''
+    Records are buffered per stream. A buffer is flushed when it reaches `buffer_size_max` rows,
+    `buffer_bytes_max` bytes or `buffer_age_max` seconds, the largest buffer is flushed
+    when all buffers hold more than `buffers_bytes_max` bytes, and all buffers are flushed at each STATE.
+
+    Streams configured with `append_dedup` destination sync mode are also merged at each STATE
+    from their `_airbyte_raw_{stream}` table (used as staging table) into a `{stream}` table
+    holding the latest version of each record by primary key.
+    '''
 
-    def __init__(self, catalog, dataset, buffer_size_max=10000):
+    def __init__(self, catalog, dataset, buffer_size_max=10000, buffer_bytes_max=9_000_000, buffer_age_max=60, buffers_bytes_max=100_000_000, max_concurrent_inserts=4, max_pending_bytes=200_000_000, log_level_min='INFO', log_sample_rate=1.0):
         super().__init__(catalog)
+        self.log_level_min = log_level_min
+        self.log_sample_rate = float(log_sample_rate)
         self.dataset = dataset
-        self.buffer_size_max = buffer_size_max
+        self.buffer_size_max = int(buffer_size_max)
+        self.buffer_bytes_max = int(buffer_bytes_max)
+        self.buffer_age_max = float(buffer_age_max)
+        self.batch_age_max = min(self.batch_age_max, self.buffer_age_max)
+        self.batch_bytes_max = min(self.batch_bytes_max, self.buffer_bytes_max)
+        self.buffers_bytes_max = int(buffers_bytes_max)
+        self.max_pending_bytes = int(max_pending_bytes)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(max_concurrent_inserts))
+        self.pending_inserts = collections.deque()
+        self.pending_bytes = 0
         self.tables = {
             **{
                 'airbyte_logs': '_airbyte_logs',
                 'airbyte_states': '_airbyte_states',
+                'airbyte_latest_state': '_airbyte_latest_state',
             },
             **{
                 stream: f'_airbyte_raw_{stream}'
                 for stream in self.streams
             },
         }
-        create_table_query = '''
-            create table if not exists `{dataset}.{table}` (
-                _airbyte_ab_id string options(description="Record uuid generated at insertion into BigQuery"),
-                _airbyte_job_started_at timestamp options(description="Extract-load job start timestamp"),
-                _airbyte_slice_started_at timestamp options(description="When incremental mode is used, data records are emitted by chunks a.k.a. slices. At the end of each slice, a state record is emitted to store a checkpoint. This column stores the timestamp when the slice started"),
-                _airbyte_emitted_at timestamp options(description="Record ingestion time into BigQuery"),
-                _airbyte_data string options(description="Record data as json string")
-            )
-            partition by date(_airbyte_emitted_at)
-            options(
-                description="{table} records ingested by bigloader"
-            )
-        '''
+        self.primary_keys = {
+            stream['stream']['name']: stream['primary_key']
+            for stream in catalog['streams']
+            if stream.get('destination_sync_mode') == 'append_dedup'
+        }
+        self.dedup_tables = {stream: stream for stream in self.primary_keys}
         import google.cloud.bigquery
         self.bigquery = google.cloud.bigquery.Client()
-        for table in self.tables.values():
-            self.bigquery.query(create_table_query.format(dataset=dataset, table=table)).result()
+        self.tables_cache_key = f'{self.bigquery.project}.{dataset}'
+        self.existing_tables = set(read_json(BIGQUERY_TABLES_CACHE_FILE, {}).get(self.tables_cache_key, []))
+        self.existing_tables_listed = False
+        self.tables_lock = threading.RLock()
+        self.create_tables([self.tables['airbyte_logs'], self.tables['airbyte_states'], self.tables['airbyte_latest_state']])
 
-    def insert_rows(self, table, records):
+    def create_tables(self, tables):
+        '''
+        Create `tables` which do not exist yet in one multi-statement query.
+        Tables known to exist are cached between runs, dataset tables are listed at most once per run.
+        '''
+        with self.tables_lock:
+            missing_tables = [table for table in tables if table not in self.existing_tables]
+            if missing_tables and not self.existing_tables_listed:
+                self.existing_tables = {table.table_id for table in self.bigquery.list_tables(self.dataset)}
+                self.existing_tables_listed = True
+                missing_tables = [table for table in tables if table not in self.existing_tables]
+            if not missing_tables:
+                return
+            query = ';\n'.join(self.get_create_table_query(table) for table in missing_tables)
+            self.bigquery.query(query).result()
+            self.existing_tables.update(missing_tables)
+            self.write_tables_cache()
+
+    def recreate_table(self, table):
+        '''
+        Create again `table` which was found missing (dropped since it was cached).
+        '''
+        with self.tables_lock:
+            print_info(f'BigQuery table {self.dataset}.{table} was not found: creating it again')
+            self.existing_tables.discard(table)
+            self.write_tables_cache()
+            self.create_tables([table])
+
+    def write_tables_cache(self):
+        tables_cache = read_json(BIGQUERY_TABLES_CACHE_FILE, {})
+        tables_cache[self.tables_cache_key] = sorted(self.existing_tables)
+        write_json_atomically(tables_cache, BIGQUERY_TABLES_CACHE_FILE)
+
+    def get_create_table_query(self, table):
+        for stream, dedup_table in self.dedup_tables.items():
+            if table == dedup_table:
+                return CREATE_DEDUP_TABLE_QUERY.format(dataset=self.dataset, table=table, stream=stream, raw_table=self.tables[stream])
+        return CREATE_TABLE_QUERIES.get(table, CREATE_TABLE_QUERY).format(dataset=self.dataset, table=table)
+
+    def insert_rows(self, table, records, slice_started_at=None):
+        '''
+        Insert `records` in the background with requests of at most `buffer_size_max` rows and `buffer_bytes_max` bytes.
+        At most `max_concurrent_inserts` requests are in flight
+        and this call blocks while more than `max_pending_bytes` of records are waiting to be inserted.
+        '''
+        chunk = []
+        chunk_bytes = 0
+        for record in records:
+            record_bytes = len(record) + ROW_OVERHEAD_BYTES
+            if chunk and (len(chunk) >= self.buffer_size_max or chunk_bytes + record_bytes > self.buffer_bytes_max):
+                self.submit_insert(table, chunk, slice_started_at)
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(record)
+            chunk_bytes += record_bytes
+        self.submit_insert(table, chunk, slice_started_at)
+
+    def submit_insert(self, table, records, slice_started_at=None):
         if not records:
             return
+        size = sum(len(record) for record in records)
+        rows = self.create_rows(table, records, slice_started_at)
         table = f'{self.dataset}.{table}'
+        self.wait_pending_inserts(max_pending_bytes=self.max_pending_bytes - size)
+        future = self.executor.submit(self.insert_rows_json, table, rows)
+        self.pending_inserts.append((future, size))
+        self.pending_bytes += size
+
+    def create_rows(self, table, records, slice_started_at=None):
         now  = datetime.datetime.utcnow().isoformat()
-        records = [
+        return [
             {
                 '_airbyte_ab_id': str(uuid.uuid4()),
                 '_airbyte_job_started_at': self.job_started_at,
-                '_airbyte_slice_started_at': self.slice_started_at,
+                '_airbyte_slice_started_at': slice_started_at or self.slice_started_at,
                 '_airbyte_emitted_at': now,
-                '_airbyte_data': record,
+                **self.create_data_columns(table, record),
             }
             for record in records
         ]
-        errors = self.bigquery.insert_rows_json(table, records)
+
+    def create_data_columns(self, table, record):
+        return {'_airbyte_data': record}
+
+    def write_logs(self, logs):
+        table = self.tables['airbyte_logs']
+        self.insert_rows_json(f'{self.dataset}.{table}', self.create_rows(table, logs))
+
+    def insert_rows_json(self, table, records, retry_not_found=True):
+        insert_started_at = time.perf_counter()
+        try:
+            errors = self.bigquery.insert_rows_json(table, records)
+        except Exception as e:
+            if len(records) > 1 and is_payload_too_large_error(e):
+                half = len(records) // 2
+                self.insert_rows_json(table, records[:half], retry_not_found=retry_not_found)
+                self.insert_rows_json(table, records[half:], retry_not_found=retry_not_found)
+                return
+            if retry_not_found and is_not_found_error(e):
+                self.recreate_table(table.split('.')[-1])
+                self.insert_rows_json(table, records, retry_not_found=False)
+                return
+            raise
+        finally:
+            if self.metrics:
+                self.metrics.observe('insert_seconds', table, time.perf_counter() - insert_started_at)
         if errors:
             raise ValueError(f'Could not insert rows to BigQuery table {table}. Errors: {errors}')
 
-    def run(self, messages):
+    def wait_pending_inserts(self, max_pending_bytes=None):
+        '''
+        Wait for the oldest pending inserts until at most `max_pending_bytes` are pending
+        (all of them if None) and raise insert errors if any.
+        '''
+        while self.pending_inserts and (
+            max_pending_bytes is None or
+            self.pending_bytes > max_pending_bytes or
+            self.pending_inserts[0][0].done()
+        ):
+            future, size = self.pending_inserts.popleft()
+            self.pending_bytes -= size
+            future.result()
+
+    def add_to_buffer(self, batch):
+        stream = batch.stream
+        if stream not in self.buffers:
+            self.buffers[stream] = StreamBuffer(getattr(batch, 'started_at', None))
+            self.slices_started_at.setdefault(stream, datetime.datetime.utcnow().isoformat())
+        buffer = self.buffers[stream]
+        size = len(batch.data) + len(batch) * ROW_OVERHEAD_BYTES
+        buffer.rows.extend(batch.rows())
+        buffer.bytes += size
+        self.buffers_bytes += size
+        if len(buffer.rows) >= self.buffer_size_max or buffer.bytes >= self.buffer_bytes_max:
+            self.flush_buffer(stream)
+        while self.buffers_bytes > self.buffers_bytes_max:
+            self.flush_buffer(max(self.buffers, key=lambda stream: self.buffers[stream].bytes))
+        now = time.monotonic()
+        if now - self.buffers_checked_at >= self.batch_age_max:
+            self.buffers_checked_at = now
+            for stream in [stream for stream, buffer in self.buffers.items() if now - buffer.started_at >= self.buffer_age_max]:
+                self.flush_buffer(stream)
+
+    def flush_buffer(self, stream):
+        self.create_tables([self.tables[stream]])
+        buffer = self.buffers.pop(stream)
+        self.buffers_bytes -= buffer.bytes
+        rows = buffer.rows
+        if stream in self.primary_keys:
+            rows = deduplicate_rows(rows, self.primary_keys[stream])
+        if self.metrics:
+            self.metrics.observe('buffer_rows', stream, len(rows))
+            self.metrics.observe('buffer_bytes', stream, buffer.bytes)
+        self.insert_rows(self.tables[stream], rows, slice_started_at=self.slices_started_at[stream])
+
+    def flush_buffers(self):
+        self.create_tables([self.tables[stream] for stream in self.buffers])
+        for stream in list(self.buffers):
+            self.flush_buffer(stream)
+
+    def run_batches(self, batches):
+        import airbyte_cdk.models
         self.job_started_at = datetime.datetime.utcnow().isoformat()
         self.slice_started_at = self.job_started_at
-        buffer = []
-        stream_table = None
-        for message in messages:
-            if message.type == airbyte_cdk.models.Type.RECORD:
-                new_stream_table = self.tables[message.record.stream]
-                if new_stream_table != stream_table and stream_table is not None:
-                    self.insert_rows(stream_table, buffer)
-                    buffer = []
+        self.buffers = {}
+        self.buffers_bytes = 0
+        self.buffers_checked_at = time.monotonic()
+        self.slices_started_at = {}
+        self.slice_streams = set()
+        log_sink = LogSink(self.write_logs, level_min=self.log_level_min, sample_rate=self.log_sample_rate)
+        try:
+            for message in batches:
+                if message.type == airbyte_cdk.models.Type.RECORD:
+                    self.slice_streams.add(message.stream)
+                    self.add_to_buffer(message)
+                elif message.type == airbyte_cdk.models.Type.STATE:
+                    checkpoint_started_at = time.perf_counter()
+                    self.flush_buffers()
+                    self.wait_pending_inserts()
+                    self.merge_dedup_tables()
+                    state = message.state.json(exclude_unset=True)
+                    self.insert_rows(self.tables['airbyte_states'], [state])
+                    self.pending_inserts.append((self.executor.submit(self.merge_latest_state, state), 0))
+                    if self.metrics:
+                        self.metrics.observe('checkpoint_seconds', self.dataset, time.perf_counter() - checkpoint_started_at)
                     self.slice_started_at = datetime.datetime.utcnow().isoformat()
-                stream_table = new_stream_table
-                buffer.append(json.dumps(message.record.data))
-                if len(buffer) > self.buffer_size_max:
-                    self.insert_rows(stream_table, buffer)
-                    buffer = []
-            elif message.type == airbyte_cdk.models.Type.STATE:
-                self.insert_rows(stream_table, buffer)
-                buffer = []
-                self.insert_rows(self.tables['airbyte_states'], [message.state.json(exclude_unset=True)])
-                self.slice_started_at = datetime.datetime.utcnow().isoformat()
-            elif message.type == airbyte_cdk.models.Type.LOG:
-                message = message.log.json(exclude_unset=True)
-                print_info(message)
-                self.insert_rows(self.tables['airbyte_logs'], [message])
-            else:
-                raise NotImplementedError(f'message type {message.type} is not managed yet')
-        self.insert_rows(stream_table, buffer)
+                    self.slices_started_at = {}
+                elif message.type == airbyte_cdk.models.Type.LOG:
+                    level = message.log.level.value
+                    message = message.log.json(exclude_unset=True)
+                    print_info(message)
+                    log_sink.log(level, message)
+                else:
+                    raise NotImplementedError(f'message type {message.type} is not managed yet')
+            self.flush_buffers()
+            self.wait_pending_inserts()
+            self.merge_dedup_tables()
+        finally:
+            log_sink.close()
+
+    def merge_dedup_tables(self):
+        '''
+        Merge records inserted since the start of the slice into the deduplicated tables of their streams
+        (records of the slice have a later `_airbyte_emitted_at`) and wait for the merges to complete.
+        '''
+        streams = [stream for stream in self.slice_streams if stream in self.dedup_tables]
+        self.slice_streams = set()
+        if not streams:
+            return
+        self.create_tables([self.dedup_tables[stream] for stream in streams])
+        for stream in streams:
+            future = self.executor.submit(self.merge_dedup_table, stream, self.slice_started_at)
+            self.pending_inserts.append((future, 0))
+        self.wait_pending_inserts()
+
+    def merge_dedup_table(self, stream, merge_from):
+        import google.cloud.bigquery
+        paths = self.primary_keys[stream]
+        primary_key = 'to_json_string(struct({}))'.format(', '.join(
+            f'json_extract(_airbyte_data, @primary_key_path_{k}) as k{k}'
+            for k in range(len(paths))
+        ))
+        job_config = google.cloud.bigquery.QueryJobConfig(query_parameters=[
+            google.cloud.bigquery.ScalarQueryParameter('merge_from', 'TIMESTAMP', merge_from),
+            *[
+                google.cloud.bigquery.ScalarQueryParameter(f'primary_key_path_{k}', 'STRING', get_json_path(path))
+                for k, path in enumerate(paths)
+            ],
+        ])
+        query = MERGE_DEDUP_TABLE_QUERY.format(
+            dataset=self.dataset,
+            table=self.dedup_tables[stream],
+            raw_table=self.tables[stream],
+            primary_key=primary_key,
+        )
+        self.bigquery.query(query, job_config=job_config).result()
+
+    def merge_latest_state(self, state):
+        import google.cloud.bigquery
+        job_config = google.cloud.bigquery.QueryJobConfig(query_parameters=[
+            google.cloud.bigquery.ScalarQueryParameter('state_key', 'STRING', LATEST_STATE_KEY),
+            google.cloud.bigquery.ScalarQueryParameter('state', 'STRING', state),
+        ])
+        self.bigquery.query(f'''
+            merge `{self.dataset}.{self.tables['airbyte_latest_state']}` latest_state
+            using (select @state_key as state_key, @state as _airbyte_data) new_state
+            on latest_state.state_key = new_state.state_key
+            when matched then
+                update set _airbyte_emitted_at = current_timestamp(), _airbyte_data = new_state._airbyte_data
+            when not matched then
+                insert (state_key, _airbyte_emitted_at, _airbyte_data)
+                values (new_state.state_key, current_timestamp(), new_state._airbyte_data)
+        ''', job_config=job_config).result()
 
     def get_state(self):
-        rows = self.bigquery.query(f'''
-            select json_extract(data, '$.data') as state
-            from {self.tables['airbyte_state']}
-            order by _airbyte_emitted_at desc
-            limit 1
-        ''').result()
-        rows = list(rows)
-        return json.loads(rows[0].state) if rows else {}
+        '''
+        Read state from the one-row latest state table, updated at each checkpoint.
+        The full states history is only scanned if the latest state table is empty (jobs run by previous versions).
+        '''
+        rows = list(self.bigquery.query(f'''
+            select json_extract(_airbyte_data, '$.data') as state
+            from `{self.dataset}.{self.tables['airbyte_latest_state']}`
+            where state_key = '{LATEST_STATE_KEY}'
+        ''').result())
+        if not rows:
+            rows = list(self.bigquery.query(f'''
+                select json_extract(_airbyte_data, '$.data') as state
+                from `{self.dataset}.{self.tables['airbyte_states']}`
+                order by _airbyte_emitted_at desc
+                limit 1
+            ''').result())
+        return json.loads(rows[0].state) if rows and rows[0].state else {}
+
+
+class BigQueryLoadDestination(BigQueryDestination):
+    '''
+    Same tables as BigQueryDestination but records are written with load jobs instead of streaming inserts.
+    Records of each stream are spooled into local gzipped NDJSON files which are loaded at each STATE
+    and whenever a file exceeds `file_size_max` bytes (uncompressed).
+    '''
+
+    def __init__(self, catalog, dataset, file_size_max=1_000_000_000, max_concurrent_inserts=4, spool_folder=None):
+        super().__init__(catalog, dataset, max_concurrent_inserts=max_concurrent_inserts)
+        self.file_size_max = int(file_size_max)
+        self.spool_folder = spool_folder
+        self.spool_files = {}
 
+    @classmethod
+    def get_class_name(cls):
+        return 'bigquery_load'
+
+    def add_to_buffer(self, batch):
+        stream = batch.stream
+        if stream not in self.spool_files:
+            filename = f'{self.current_spool_folder}/{stream}_{uuid.uuid4().hex}.jsonl.gz'
+            self.spool_files[stream] = (filename, gzip.open(filename, 'wt', encoding='utf-8', compresslevel=1))
+        filename, file = self.spool_files[stream]
+        now = datetime.datetime.utcnow().isoformat()
+        rows = batch.rows()
+        if stream in self.primary_keys:
+            rows = deduplicate_rows(rows, self.primary_keys[stream])
+        for row in rows:
+            file.write(json.dumps({
+                '_airbyte_ab_id': str(uuid.uuid4()),
+                '_airbyte_job_started_at': self.job_started_at,
+                '_airbyte_slice_started_at': self.slice_started_at,
+                '_airbyte_emitted_at': now,
+                '_airbyte_data': row,
+            }) + '\n')
+        if file.tell() > self.file_size_max:
+            self.flush_buffer(stream)
+
+    def flush_buffer(self, stream):
+        self.create_tables([self.tables[stream]])
+        filename, file = self.spool_files.pop(stream)
+        if self.metrics:
+            self.metrics.observe('spool_file_bytes', stream, file.tell())
+        file.close()
+        future = self.executor.submit(self.load_file, self.tables[stream], filename)
+        self.pending_inserts.append((future, 0))
+
+    def flush_buffers(self):
+        self.create_tables([self.tables[stream] for stream in self.spool_files])
+        for stream in list(self.spool_files):
+            self.flush_buffer(stream)
+
+    def load_file(self, table, filename, retry_not_found=True):
+        import google.cloud.bigquery
+        job_config = google.cloud.bigquery.LoadJobConfig(
+            source_format=google.cloud.bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=google.cloud.bigquery.WriteDisposition.WRITE_APPEND,
+        )
+        load_started_at = time.perf_counter()
+        try:
+            with open(filename, 'rb') as f:
+                job = self.bigquery.load_table_from_file(f, f'{self.dataset}.{table}', job_config=job_config)
+                job.result()
+        except Exception as e:
+            if not (retry_not_found and is_not_found_error(e)):
+                raise
+            self.recreate_table(table)
+            self.load_file(table, filename, retry_not_found=False)
+            return
+        os.remove(filename)
+        if self.metrics:
+            self.metrics.observe('load_seconds', table, time.perf_counter() - load_started_at)
+
+    def run_batches(self, batches):
+        with tempfile.TemporaryDirectory(dir=self.spool_folder) as self.current_spool_folder:
+            super().run_batches(batches)
+
+
+class BigQueryTypedDestination(BigQueryDestination):
+    '''
+    Same as BigQueryDestination but records of each stream are inserted into `_airbyte_typed_{stream}` tables
+    with one nullable column per property of the stream `json_schema` instead of a single `_airbyte_data` json string.
+    Objects, arrays and fields with several types are stored in JSON columns. Fields missing from `json_schema`
+    and values which do not match their column type are stored in the `_airbyte_unparsed` json string column.
+
+    Properties added to `json_schema` since the table creation are added to the table as nullable columns.
+    Columns whose type changed keep their current type.
+    '''
+
+    def __init__(self, catalog, dataset, max_concurrent_inserts=4):
+        if any(stream.get('destination_sync_mode') == 'append_dedup' for stream in catalog['streams']):
+            raise ValueError('`append_dedup` sync mode is not supported by bigquery_typed destination')
+        self.typed_tables = {}
+        self.columns = {}
+        for stream in catalog['streams']:
+            table = f'_airbyte_typed_{stream["stream"]["name"]}'
+            self.typed_tables[table] = stream['stream']['name']
+            self.columns[table] = {}
+            for field, field_schema in stream['stream'].get('json_schema', {}).get('properties', {}).items():
+                column = get_bigquery_column_name(field)
+                if column.lower().startswith('_airbyte_') or column.lower() in {c.lower() for c, _ in self.columns[table].values()}:
+                    continue
+                self.columns[table][field] = (column, get_column_kind(field_schema))
+        self.checked_tables = set()
+        super().__init__(catalog, dataset, max_concurrent_inserts=max_concurrent_inserts)
+        self.tables.update({stream: table for table, stream in self.typed_tables.items()})
 
+    @classmethod
+    def get_class_name(cls):
+        return 'bigquery_typed'
+
+    def get_create_table_query(self, table):
+        if table not in self.typed_tables:
+            return super().get_create_table_query(table)
+        columns = ''.join(
+            f'`{column}` {BIGQUERY_COLUMN_TYPES[kind]},\n        '
+            for column, kind in self.columns[table].values()
+        )
+        return CREATE_TYPED_TABLE_QUERY.format(dataset=self.dataset, table=table, columns=columns)
+
+    def create_tables(self, tables):
+        '''
+        Create missing tables then add the columns missing from typed tables checked for the first time in this run.
+        '''
+        super().create_tables(tables)
+        tables = [table for table in tables if table in self.typed_tables and table not in self.checked_tables]
+        queries = []
+        for table in tables:
+            existing_columns = {
+                field.name.lower(): field.field_type
+                for field in self.bigquery.get_table(f'{self.dataset}.{table}').schema
+            }
+            missing_columns = []
+            for field, (column, kind) in list(self.columns[table].items()):
+                if column.lower() not in existing_columns:
+                    missing_columns.append(f'add column if not exists `{column}` {BIGQUERY_COLUMN_TYPES[kind]}')
+                elif existing_columns[column.lower()] in BIGQUERY_COLUMN_KINDS:
+                    self.columns[table][field] = (column, BIGQUERY_COLUMN_KINDS[existing_columns[column.lower()]])
+                else:
+                    del self.columns[table][field]
+            if missing_columns:
+                queries.append(f'alter table `{self.dataset}.{table}` ' + ', '.join(missing_columns))
+        if queries:
+            self.bigquery.query(';\n'.join(queries)).result()
+        self.checked_tables.update(tables)
+
+    def create_data_columns(self, table, record):
+        if table not in self.typed_tables:
+            return super().create_data_columns(table, record)
+        values, unparsed = split_record(json.loads(record), self.columns[table])
+        values[UNPARSED_COLUMN] = unparsed
+        return values
 
 DESTINATIONS = {
     destination.get_class_name(): destination
-    for destination in [LocalJsonDestination, BigQueryDestination, PrintDestination]
+    for destination in [LocalJsonDestination, ParquetDestination, BigQueryDestination, BigQueryLoadDestination, BigQueryTypedDestination, PrintDestination]
 }
 
 
@@ -0,0 +1,158 @@
+import os
+import re
+import glob
+import gzip
+import queue
+import bisect
+import threading
+
+
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+COMPRESSIONS_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+class RecordsFileWriter:
+    '''
+    Write serialized records (bytes of newline terminated json documents) from a background thread.
+
+    If neither `compression`, `part_size_max` (uncompressed bytes) nor `part_records_max` is set,
+    records are appended to `{folder}/{stream}.jsonl`.
+    Else they are written into `{folder}/{stream}/part-00001.jsonl[.gz|.zst]` files: each run starts a new part
+    and written data is split so that parts hold at most `part_size_max` bytes and `part_records_max` records
+    (a part holds at least one record, even if larger than `part_size_max`).
+
+    Data is only fsynced by `sync()`, called at STATE checkpoints.
+    '''
+
+    def __init__(self, folder, stream, compression=None, part_size_max=None, part_records_max=None):
+        if compression not in COMPRESSIONS_EXTENSIONS:
+            raise ValueError(f'Compression `{compression}` is not supported. Accepted values are gzip, zstd')
+        self.compression = compression
+        self.part_size_max = part_size_max
+        self.part_records_max = part_records_max
+        self.is_partitioned = bool(compression or part_size_max or part_records_max)
+        if self.is_partitioned:
+            self.folder = f'{folder}/{stream}'
+            os.makedirs(self.folder, exist_ok=True)
+            parts = [
+                int(re.findall(r'part-(\d+)', filename)[0])
+                for filename in glob.glob(f'{self.folder}/part-*.jsonl*')
+            ]
+            self.part = max(parts, default=0) + 1
+        else:
+            self.filename = f'{folder}/{stream}.jsonl'
+        self.part_size = 0
+        self.part_records = 0
+        self.file = None
+        self.raw_file = None
+        self.error = None
+        self.queue = queue.Queue(maxsize=64)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, data, records, offsets=None):
+        '''
+        Write `records` newline terminated json documents `data`. `offsets[k]` is the position of the k-th record in `data`
+        (found from line endings if not given) and is used to split `data` between parts.
+        '''
+        if not (self.part_size_max or self.part_records_max):
+            self.send('write', bytes(data))
+            return
+        if offsets is None:
+            offsets = [0] + [k + 1 for k, byte in enumerate(data[:-1]) if byte == 10]
+        bounds = list(offsets) + [len(data)]
+        start = 0
+        while start < records:
+            end = records
+            if self.part_records_max:
+                end = min(end, start + self.part_records_max - self.part_records)
+            if self.part_size_max:
+                end = min(end, bisect.bisect_right(bounds, bounds[start] + self.part_size_max - self.part_size) - 1)
+            if end <= start:
+                if self.part_records:
+                    self.send('rotate')
+                    self.part_size = 0
+                    self.part_records = 0
+                    continue
+                end = start + 1
+            self.part_size += bounds[end] - bounds[start]
+            self.part_records += end - start
+            self.send('write', bytes(data[bounds[start]:bounds[end]]))
+            start = end
+
+    def sync(self):
+        done = threading.Event()
+        self.send('sync', done)
+        done.wait()
+        self.raise_error()
+
+    def close(self):
+        '''
+        Close the file, even after an error (raised once the file is closed).
+        '''
+        self.queue.put(('close', None))
+        self.thread.join()
+        self.raise_error()
+
+    def send(self, command, argument=None):
+        self.raise_error()
+        self.queue.put((command, argument))
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        while True:
+            command, argument = self.queue.get()
+            if self.error is None or command == 'close':
+                try:
+                    self.execute(command, argument)
+                except Exception as e:
+                    self.error = self.error or e
+            if command == 'sync':
+                argument.set()
+            elif command == 'close':
+                return
+
+    def execute(self, command, argument):
+        if command == 'write':
+            if self.file is None:
+                self.open()
+            self.file.write(argument)
+        elif command == 'rotate':
+            self.close_file()
+            self.part += 1
+        elif command == 'sync' and self.file is not None:
+            self.file.flush()
+            if self.raw_file is not self.file:
+                self.raw_file.flush()
+            os.fsync(self.raw_file.fileno())
+        elif command == 'close':
+            self.close_file()
+
+    def open(self):
+        if not self.is_partitioned:
+            self.raw_file = self.file = open(self.filename, 'ab', buffering=WRITE_BUFFER_SIZE)
+            return
+        filename = f'{self.folder}/part-{self.part:05d}.jsonl{COMPRESSIONS_EXTENSIONS[self.compression]}'
+        self.raw_file = open(filename, 'xb', buffering=WRITE_BUFFER_SIZE)
+        if self.compression == 'gzip':
+            self.file = gzip.GzipFile(fileobj=self.raw_file, mode='wb', compresslevel=6)
+        elif self.compression == 'zstd':
+            import zstandard
+            self.file = zstandard.ZstdCompressor().stream_writer(self.raw_file, closefd=False)
+        else:
+            self.file = self.raw_file
+
+    def close_file(self):
+        if self.file is None:
+            return
+        file, raw_file = self.file, self.raw_file
+        self.file = None
+        self.raw_file = None
+        try:
+            file.close()
+        finally:
+            if raw_file is not file:
+                raw_file.close()
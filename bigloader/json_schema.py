@@ -0,0 +1,58 @@
+import json
+
+
+UNPARSED_COLUMN = '_airbyte_unparsed'
+
+
+def get_column_kind(field_schema):
+    '''
+    Return the kind of column (integer, number, boolean, string or json) used to store a field of `json_schema`.
+    Objects, arrays and fields with several or unknown types are stored as json.
+    '''
+    types = field_schema.get('type', [])
+    if isinstance(types, str):
+        types = [types]
+    types = [t for t in types if t != 'null']
+    if len(types) != 1 or types[0] not in ('integer', 'number', 'boolean', 'string'):
+        return 'json'
+    return types[0]
+
+
+def is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool) and -2**63 <= value < 2**63
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+VALUE_CHECKS = {
+    'integer': is_integer,
+    'number': is_number,
+    'boolean': lambda value: isinstance(value, bool),
+    'string': lambda value: isinstance(value, str),
+}
+
+
+def split_record(record, columns):
+    '''
+    Split `record` into the values of `columns` (a dict `{field: (column, kind)}`)
+    and the json string of the fields which are not in `columns` or whose value does not match their column kind
+    (None if there is no such field). Values of json columns are serialized, null values are omitted.
+    '''
+    values = {}
+    unparsed = {}
+    for field, value in record.items():
+        if field not in columns:
+            unparsed[field] = value
+        elif value is None:
+            continue
+        else:
+            column, kind = columns[field]
+            if kind == 'json':
+                values[column] = json.dumps(value)
+            elif VALUE_CHECKS[kind](value):
+                values[column] = value
+            else:
+                unparsed[field] = value
+    return values, json.dumps(unparsed) if unparsed else None
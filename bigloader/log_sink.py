@@ -0,0 +1,75 @@
+import time
+import queue
+import random
+import threading
+
+
+LOG_LEVELS = {
+    'TRACE': 5,
+    'DEBUG': 10,
+    'INFO': 20,
+    'WARN': 30,
+    'WARNING': 30,
+    'ERROR': 40,
+    'FATAL': 50,
+    'CRITICAL': 50,
+}
+
+
+class LogSink:
+    '''
+    Send log rows to `write_rows(rows)` by batches from a background thread.
+    A batch is written when it reaches `batch_size_max` rows, every `flush_interval` seconds and on `close()`.
+    Logs below `level_min` are ignored, logs below ERROR are kept with probability `sample_rate`
+    and logs are dropped (and counted in `dropped`) when `queue_size_max` logs are waiting:
+    `log` never blocks the caller.
+    '''
+
+    def __init__(self, write_rows, level_min='INFO', sample_rate=1.0, batch_size_max=500, flush_interval=5, queue_size_max=10000):
+        self.write_rows = write_rows
+        self.level_min = LOG_LEVELS[level_min.upper()]
+        self.sample_rate = float(sample_rate)
+        self.batch_size_max = batch_size_max
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size_max)
+        self.dropped = 0
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def log(self, level, row):
+        level = LOG_LEVELS.get(str(level).upper(), LOG_LEVELS['INFO'])
+        if level < self.level_min:
+            return
+        if level < LOG_LEVELS['ERROR'] and self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        rows = []
+        flush_at = time.monotonic() + self.flush_interval
+        while not (self.closed.is_set() and self.queue.empty()):
+            try:
+                rows.append(self.queue.get(timeout=max(0, min(flush_at - time.monotonic(), 0.5))))
+            except queue.Empty:
+                pass
+            if len(rows) >= self.batch_size_max or time.monotonic() >= flush_at:
+                self.flush(rows)
+                rows = []
+                flush_at = time.monotonic() + self.flush_interval
+        self.flush(rows)
+
+    def flush(self, rows):
+        if not rows:
+            return
+        try:
+            self.write_rows(rows)
+        except Exception as e:
+            print(f'Could not write {len(rows)} log rows: {e}')
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
@@ -5,12 +5,26 @@ import tempfile
 import platform
 import datetime
 import logging
+import time
+import threading
 import yaml
 
 
 import airbyte_cdk.entrypoint
 import airbyte_cdk.logger
 
+try:
+    from .log_sink import LogSink
+    from .metrics import Metrics
+    from .utils import read_json, write_json_atomically, CACHE_FOLDER
+except ImportError:
+    from log_sink import LogSink
+    from metrics import Metrics
+    from utils import read_json, write_json_atomically, CACHE_FOLDER
+
+
+BIGQUERY_TABLES_CACHE_FILE = f'{CACHE_FOLDER}/bigquery_tables.json'
+
 
 logger = logging.getLogger('bigloader')
 logger.setLevel('INFO')
@@ -136,6 +150,8 @@ class AirbyteSource:
 
 class BaseDestination:
 
+    metrics = None
+
     def __init__(self, config):
         self.config = config
         self.job_started_at = datetime.datetime.utcnow().isoformat()
@@ -148,13 +164,16 @@ class BaseDestination:
     def handle_log_message(self, level, message):
         pass
 
+    def close(self):
+        pass
+
     def get_state(self):
         return {}
 
 
 class BigQueryDestination(BaseDestination):
 
-    def __init__(self, config, streams, buffer_size_max=1000):
+    def __init__(self, config, streams, buffer_size_max=1000, log_level_min='INFO', log_sample_rate=1.0):
         self.buffer_size_max = buffer_size_max
         import google.cloud.bigquery
         self.bigquery = google.cloud.bigquery.Client()
@@ -162,16 +181,18 @@ class BigQueryDestination(BaseDestination):
         self.logs_table = config['table'].format(stream='_logs')
         self.states_table = config['table'].format(stream='_states')
         print(streams)
-        for stream in streams:
-            self.bigquery.query(f'''
+        self.create_table_queries = {
+            self.stream_table(stream): f'''
                 create table if not exists {self.stream_table(stream)} (
                     job_started_at timestamp,
                     slice_started_at timestamp,
                     inserted_at timestamp,
                     data string
                 )
-            ''').result()
-        self.bigquery.query(f'''
+            '''
+            for stream in streams
+        }
+        self.create_table_queries[self.logs_table] = f'''
             create table if not exists {self.logs_table} (
                 job_started_at timestamp,
                 slice_started_at timestamp,
@@ -179,20 +200,77 @@ class BigQueryDestination(BaseDestination):
                 level string,
                 data string
             )
-        ''').result()
-        self.bigquery.query(f'''
+        '''
+        self.create_table_queries[self.states_table] = f'''
             create table if not exists {self.states_table} (
                 job_started_at timestamp,
                 slice_started_at timestamp,
                 inserted_at timestamp,
                 state string
             )
-        ''').result()
+        '''
+        self.tables_lock = threading.RLock()
+        self.existing_tables = {
+            f'{dataset}.{table}'
+            for dataset, tables in read_json(BIGQUERY_TABLES_CACHE_FILE, {}).items()
+            for table in tables
+        }
+        self.listed_datasets = set()
+        # stream tables are created when their first rows are inserted
+        self.create_tables([self.logs_table, self.states_table])
         super().__init__(config)
+        self.log_sink = LogSink(
+            lambda rows: self.insert_rows(self.logs_table, rows),
+            level_min=config.get('log_level_min', log_level_min),
+            sample_rate=config.get('log_sample_rate', log_sample_rate),
+        )
+
+    def get_dataset(self, table):
+        dataset = table.replace('`', '').rsplit('.', 1)[0]
+        return dataset if '.' in dataset else f'{self.bigquery.project}.{dataset}'
+
+    def get_table_id(self, table):
+        return f"{self.get_dataset(table)}.{table.replace('`', '').rsplit('.', 1)[-1]}"
+
+    def create_tables(self, tables):
+        '''
+        Create `tables` which do not exist yet in one multi-statement query.
+        Tables known to exist are cached between runs, each dataset is listed at most once per run.
+        '''
+        with self.tables_lock:
+            missing_tables = [table for table in tables if self.get_table_id(table) not in self.existing_tables]
+            for dataset in {self.get_dataset(table) for table in missing_tables} - self.listed_datasets:
+                self.existing_tables = {table for table in self.existing_tables if self.get_dataset(table) != dataset}
+                self.existing_tables.update(f'{dataset}.{table.table_id}' for table in self.bigquery.list_tables(dataset))
+                self.listed_datasets.add(dataset)
+            missing_tables = [table for table in tables if self.get_table_id(table) not in self.existing_tables]
+            if not missing_tables:
+                return
+            # one multi-statement job instead of one blocking job per table
+            self.bigquery.query(';'.join(self.create_table_queries[table] for table in missing_tables)).result()
+            self.existing_tables.update(self.get_table_id(table) for table in missing_tables)
+            self.write_tables_cache()
+
+    def recreate_table(self, table):
+        with self.tables_lock:
+            logger.warning(f'BigQuery table {table} was not found: creating it again')
+            self.existing_tables.discard(self.get_table_id(table))
+            self.write_tables_cache()
+            self.create_tables([table])
+
+    def write_tables_cache(self):
+        tables_cache = read_json(BIGQUERY_TABLES_CACHE_FILE, {})
+        datasets = {table.rsplit('.', 1)[0] for table in self.existing_tables} | self.listed_datasets
+        for dataset in datasets:
+            tables_cache[dataset] = sorted(
+                table.rsplit('.', 1)[1] for table in self.existing_tables if table.rsplit('.', 1)[0] == dataset
+            )
+        write_json_atomically(tables_cache, BIGQUERY_TABLES_CACHE_FILE)
 
-    def insert_rows(self, table, rows):
+    def insert_rows(self, table, rows, retry_not_found=True):
         if not rows:
             return
+        self.create_tables([table])
         now  = datetime.datetime.utcnow().isoformat()
         rows = [
             {
@@ -205,7 +283,16 @@ class BigQueryDestination(BaseDestination):
             }
             for row in rows
         ]
-        errors = self.bigquery.insert_rows_json(table, rows)
+        insert_started_at = time.perf_counter()
+        try:
+            errors = self.bigquery.insert_rows_json(table, rows)
+        except Exception as e:
+            if not (retry_not_found and getattr(e, 'code', None) == 404):
+                raise
+            self.recreate_table(table)
+            errors = self.bigquery.insert_rows_json(table, rows)
+        if self.metrics:
+            self.metrics.observe('insert_seconds', table, time.perf_counter() - insert_started_at)
         if errors:
             raise ValueError(f'Could not insert rows to BigQuery table {table}. Errors: {errors}')
 
@@ -214,7 +301,10 @@ class BigQueryDestination(BaseDestination):
         buffer = []
         stream_table = None
         for message in messages:
+            parse_started_at = time.perf_counter()
             message = json.loads(message)
+            if self.metrics:
+                self.metrics.add_parse_time(message['record']['stream'] if message['type'] == 'RECORD' else None, time.perf_counter() - parse_started_at)
             if message['type'] == 'RECORD':
                 new_stream_table = self.stream_table(message['record']['stream'])
                 if new_stream_table != stream_table:
@@ -223,7 +313,11 @@ class BigQueryDestination(BaseDestination):
                     self.slice_started_at = datetime.datetime.utcnow().isoformat()
                 stream_table = new_stream_table
                 buffer.append({'data': json.dumps(message['record']['data'])})
+                if self.metrics:
+                    self.metrics.add_records(message['record']['stream'], 1, len(buffer[-1]['data']))
                 if len(buffer) > self.buffer_size_max:
+                    if self.metrics:
+                        self.metrics.observe('buffer_rows', message['record']['stream'], len(buffer))
                     self.insert_rows(stream_table, buffer)
                     buffer = []
             elif message['type'] == 'STATE':
@@ -240,7 +334,10 @@ class BigQueryDestination(BaseDestination):
         self.insert_rows(stream_table, buffer)
 
     def handle_log_message(self, level, message):
-        self.insert_rows(self.logs_table, [{'level': level, 'data': message}])
+        self.log_sink.log(level, {'level': level, 'data': message})
+
+    def close(self):
+        self.log_sink.close()
 
     def get_state(self):
         rows = self.bigquery.query(f'''
@@ -253,12 +350,21 @@ class BigQueryDestination(BaseDestination):
         return json.loads(rows[0].state) if rows else {}
 
 
-def run_extract_load(source_name, source_config, destination_config, streams=None):
+def run_extract_load(source_name, source_config, destination_config, streams=None, metrics_file=None, prometheus_file=None):
     source = AirbyteSource(source_name, source_config)
     destination = BigQueryDestination(destination_config, streams=streams or source.streams)
     patch_logger_to_send_logs_to_destination(destination)
     state = destination.get_state()
-    source.read(handle_messages=destination.handle_messages, state=state, streams=streams)
+    handle_messages = destination.handle_messages
+    if metrics_file:
+        destination.metrics = Metrics(metrics_file, prometheus_file=prometheus_file)
+        handle_messages = lambda messages: destination.handle_messages(destination.metrics.track_messages(messages))
+    try:
+        source.read(handle_messages=handle_messages, state=state, streams=streams)
+    finally:
+        destination.close()
+        if destination.metrics:
+            destination.metrics.close()
 
 
 if __name__ == '__main__':
@@ -270,6 +376,8 @@ if __name__ == '__main__':
     )
     parser.add_argument('config_filename')
     parser.add_argument('--streams')
+    parser.add_argument('--metrics', help='write a json summary of job metrics into this file')
+    parser.add_argument('--prometheus-file', help='also write job metrics in Prometheus text format into this file every 10 seconds')
     args = parser.parse_args()
     config_filename = args.config_filename
     streams = args.streams.split(',') if args.streams else None
@@ -278,5 +386,5 @@ if __name__ == '__main__':
     config = yaml.load(open(config_filename, encoding='utf-8'), Loader=yaml.loader.SafeLoader)
     source_config = config['source_configuration']
     destination_config = config['destination_configuration']
-    run_extract_load(source_name, source_config, destination_config, streams)
+    run_extract_load(source_name, source_config, destination_config, streams, metrics_file=args.metrics, prometheus_file=args.prometheus_file)
 
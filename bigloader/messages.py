@@ -0,0 +1,167 @@
+import json
+import time
+
+import airbyte_cdk.models
+
+
+# Layout of RECORD messages as serialized by airbyte_cdk (`message.json(exclude_unset=True)`)
+RECORD_PREFIX = '{"type": "RECORD", "record": {"stream": '
+DATA_SEPARATOR = ', "data": '
+EMITTED_AT_SEPARATOR = ', "emitted_at": '
+
+json_decoder = json.JSONDecoder()
+
+
+class Record:
+
+    def __init__(self, stream, data_json=None, data=None):
+        self.stream = stream
+        self._data_json = data_json
+        self._data = data
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = json.loads(self._data_json)
+        return self._data
+
+    @property
+    def data_json(self):
+        if self._data_json is None:
+            self._data_json = json.dumps(self._data)
+        return self._data_json
+
+
+class RecordMessage:
+    '''
+    Lightweight stand-in for `airbyte_cdk.models.AirbyteMessage` of type RECORD.
+    It exposes the same `type`, `record.stream`, `record.data` and `json()` attributes
+    but keeps the serialized line so that record data is only parsed when needed.
+    '''
+
+    type = airbyte_cdk.models.Type.RECORD
+
+    def __init__(self, line, record):
+        self.line = line
+        self.record = record
+
+    def json(self, **kwargs):
+        if self.line is None:
+            self.line = f'{{"type": "RECORD", "record": {{"stream": {json.dumps(self.record.stream)}, "data": {self.record.data_json}}}}}'
+        return self.line
+
+
+def decode_record_fast(line):
+    if not line.startswith(RECORD_PREFIX):
+        return None
+    try:
+        stream, end = json_decoder.raw_decode(line, len(RECORD_PREFIX))
+    except ValueError:
+        return None
+    if not isinstance(stream, str) or not line.startswith(DATA_SEPARATOR, end):
+        return None
+    data_start = end + len(DATA_SEPARATOR)
+    # data may contain nested `emitted_at` keys but record `emitted_at` is always the last one
+    data_end = line.rfind(EMITTED_AT_SEPARATOR, data_start)
+    if data_end == -1:
+        return None
+    return RecordMessage(line, Record(stream, data_json=line[data_start:data_end]))
+
+
+def decode_message(line):
+    '''
+    Decode a line emitted by an airbyte connector.
+    RECORD messages are returned as `RecordMessage` without building any pydantic model.
+    Other messages (LOG, STATE, TRACE, SPEC, CATALOG, ...) are returned as `airbyte_cdk.models.AirbyteMessage`.
+    Returns None if line is not an airbyte message.
+    '''
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    line = line.strip()
+    if not line.startswith('{'):
+        return None
+    message = decode_record_fast(line)
+    if message is not None:
+        return message
+    try:
+        content = json.loads(line)
+        if content.get('type') == 'RECORD':
+            record = content['record']
+            return RecordMessage(line, Record(record['stream'], data=record['data']))
+        return airbyte_cdk.models.AirbyteMessage.parse_obj(content)
+    except Exception:
+        return None
+
+
+class RecordBatch:
+    '''
+    Consecutive records of one stream stored as their serialized `data` (one json document per line)
+    in a single bytes buffer. `offsets[k]` is the position of the k-th record in `data`.
+    `started_at` is the `time.monotonic()` of the batch creation (when its first record was received).
+    '''
+
+    type = airbyte_cdk.models.Type.RECORD
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.data = bytearray()
+        self.offsets = []
+        self.started_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, data_json):
+        self.offsets.append(len(self.data))
+        self.data += data_json.encode('utf-8')
+        self.data += b'\n'
+
+    def rows(self):
+        ends = self.offsets[1:] + [len(self.data)]
+        for start, end in zip(self.offsets, ends):
+            yield self.data[start:end - 1].decode('utf-8')
+
+    def messages(self):
+        for row in self.rows():
+            yield RecordMessage(None, Record(self.stream, data_json=row))
+
+
+def batch_messages(messages, batch_size=1000, batch_bytes_max=1_000_000, batch_age_max=1.0):
+    '''
+    Group consecutive RECORD messages of the same stream into `RecordBatch` of at most `batch_size` records.
+    A batch is also yielded once it holds `batch_bytes_max` bytes or `batch_age_max` seconds after its first record
+    (checked at each message) so that records of slow streams reach the destination in time.
+    Other messages are yielded as is, after the records received before them.
+    '''
+    batch = None
+    for message in messages:
+        if message.type == airbyte_cdk.models.Type.RECORD:
+            record = message.record
+            if batch is not None and batch.stream != record.stream:
+                yield batch
+                batch = None
+            if batch is None:
+                batch = RecordBatch(record.stream)
+            batch.append(record.data_json if isinstance(record, Record) else json.dumps(record.data))
+            if (
+                len(batch) >= batch_size or
+                len(batch.data) >= batch_bytes_max or
+                time.monotonic() - batch.started_at >= batch_age_max
+            ):
+                yield batch
+                batch = None
+        else:
+            if batch is not None:
+                yield batch
+                batch = None
+            yield message
+    if batch is not None:
+        yield batch
+
+
+def unbatch_messages(batches):
+    for batch in batches:
+        if isinstance(batch, RecordBatch):
+            yield from batch.messages()
+        else:
+            yield batch
@@ -0,0 +1,180 @@
+import json
+import time
+import bisect
+import threading
+import collections
+
+import airbyte_cdk.models
+
+try:
+    from .utils import write_file_atomically
+except ImportError:
+    from utils import write_file_atomically
+
+
+HISTOGRAMS_BUCKETS = {
+    'seconds': [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300],
+    'rows': [1, 10, 100, 1000, 10000, 100000, 1000000],
+    'bytes': [10**3, 10**4, 10**5, 10**6, 10**7, 10**8, 10**9],
+}
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        total = 0
+        for le, count in zip(self.buckets + ['+Inf'], self.counts):
+            total += count
+            yield le, total
+
+
+class Metrics:
+    '''
+    Collect job metrics: records and bytes per stream, parse time per stream,
+    time spent waiting for the source (next message) versus handling messages in the destination,
+    and histograms observed by destinations (buffer sizes, flush latencies, ...).
+
+    A json summary is written into `filename` by `close()`. If `prometheus_file` is set,
+    metrics are also written in Prometheus text format every `prometheus_interval` seconds
+    (to be collected by node_exporter textfile collector).
+    Histogram names end with their unit (`_seconds`, `_rows` or `_bytes`) which defines their buckets.
+    '''
+
+    def __init__(self, filename, prometheus_file=None, prometheus_interval=10):
+        self.filename = filename
+        self.prometheus_file = prometheus_file
+        self.prometheus_interval = prometheus_interval
+        self.started_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.records = collections.Counter()
+        self.bytes = collections.Counter()
+        self.parse_seconds = collections.Counter()
+        self.source_wait_seconds = 0
+        self.destination_seconds = 0
+        self.histograms = {}
+        self.closed = threading.Event()
+        if prometheus_file:
+            self.thread = threading.Thread(target=self.run_prometheus_writer, daemon=True)
+            self.thread.start()
+
+    def add_records(self, stream, records, size):
+        with self.lock:
+            self.records[stream] += records
+            self.bytes[stream] += size
+
+    def add_parse_time(self, stream, seconds):
+        with self.lock:
+            self.parse_seconds[stream] += seconds
+
+    def observe(self, name, label, value):
+        with self.lock:
+            if (name, label) not in self.histograms:
+                self.histograms[(name, label)] = Histogram(HISTOGRAMS_BUCKETS[name.split('_')[-1]])
+            self.histograms[(name, label)].observe(value)
+
+    def track_messages(self, messages):
+        '''
+        Yield `messages`, counting records and measuring the time spent waiting for the next message
+        versus the time spent by the consumer before asking for it.
+        '''
+        messages = iter(messages)
+        while True:
+            waiting_since = time.perf_counter()
+            try:
+                message = next(messages)
+            except StopIteration:
+                break
+            received_at = time.perf_counter()
+            self.source_wait_seconds += received_at - waiting_since
+            if getattr(message, 'type', None) == airbyte_cdk.models.Type.RECORD:
+                record = message.record
+                data_json = getattr(record, 'data_json', None)
+                self.add_records(record.stream, 1, len(data_json) if data_json is not None else 0)
+            yield message
+            self.destination_seconds += time.perf_counter() - received_at
+
+    def get_summary(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started_at
+            return {
+                'elapsed_seconds': elapsed,
+                'source_wait_seconds': self.source_wait_seconds,
+                'destination_seconds': self.destination_seconds,
+                'parse_seconds': sum(self.parse_seconds.values()),
+                'streams': {
+                    stream: {
+                        'records': self.records[stream],
+                        'bytes': self.bytes[stream],
+                        'records_per_second': self.records[stream] / elapsed if elapsed else 0,
+                        'bytes_per_second': self.bytes[stream] / elapsed if elapsed else 0,
+                        'parse_seconds': self.parse_seconds[stream],
+                    }
+                    for stream in sorted(set(self.records) | set(s for s in self.parse_seconds if s is not None))
+                },
+                'histograms': {
+                    name: {
+                        label: {
+                            'count': histogram.count,
+                            'sum': histogram.sum,
+                            'buckets': {str(le): count for le, count in histogram.cumulative_counts()},
+                        }
+                        for (histogram_name, label), histogram in sorted(self.histograms.items())
+                        if histogram_name == name
+                    }
+                    for name in sorted(set(name for name, _ in self.histograms))
+                },
+            }
+
+    def get_prometheus_text(self):
+        summary = self.get_summary()
+        lines = []
+
+        def add_metric(name, metric_type, values):
+            lines.append(f'# TYPE bigloader_{name} {metric_type}')
+            for labels, value in values:
+                labels = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f'bigloader_{name}{{{labels}}} {value}' if labels else f'bigloader_{name} {value}')
+
+        streams = summary['streams']
+        add_metric('elapsed_seconds', 'gauge', [({}, summary['elapsed_seconds'])])
+        add_metric('source_wait_seconds_total', 'counter', [({}, summary['source_wait_seconds'])])
+        add_metric('destination_seconds_total', 'counter', [({}, summary['destination_seconds'])])
+        add_metric('records_total', 'counter', [({'stream': s}, m['records']) for s, m in streams.items()])
+        add_metric('bytes_total', 'counter', [({'stream': s}, m['bytes']) for s, m in streams.items()])
+        add_metric('parse_seconds_total', 'counter', [({'stream': s}, m['parse_seconds']) for s, m in streams.items()])
+        for name, histograms in summary['histograms'].items():
+            lines.append(f'# TYPE bigloader_{name} histogram')
+            for label, histogram in histograms.items():
+                for le, count in histogram['buckets'].items():
+                    lines.append(f'bigloader_{name}_bucket{{label="{label}",le="{le}"}} {count}')
+                lines.append(f'bigloader_{name}_sum{{label="{label}"}} {histogram["sum"]}')
+                lines.append(f'bigloader_{name}_count{{label="{label}"}} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus_file(self):
+        write_file_atomically(self.get_prometheus_text(), self.prometheus_file)
+
+    def run_prometheus_writer(self):
+        while not self.closed.wait(self.prometheus_interval):
+            try:
+                self.write_prometheus_file()
+            except Exception as e:
+                print(f'Could not write metrics to {self.prometheus_file}: {e}')
+
+    def close(self):
+        self.closed.set()
+        if self.prometheus_file:
+            self.thread.join()
+            self.write_prometheus_file()
+        write_file_atomically(json.dumps(self.get_summary(), indent=4), self.filename)
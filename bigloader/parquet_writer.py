@@ -0,0 +1,91 @@
+import os
+import re
+import glob
+import json
+
+from .json_schema import get_column_kind, split_record, UNPARSED_COLUMN
+
+
+class ParquetFileWriter:
+    '''
+    Write records of `stream` into `{folder}/{stream}/part-00001.parquet` (each run starts a new part)
+    with one column per property of `json_schema` and a `_airbyte_unparsed` json column
+    holding the fields which are not in `json_schema` or whose value does not match their column type.
+
+    Records are buffered in columns and written as a row group every `row_group_size` records.
+    A parquet file is only readable once closed (its footer is written last): `sync()`, called at STATE checkpoints,
+    closes and fsyncs the current part and the next records are written into a new part.
+    '''
+
+    def __init__(self, folder, stream, json_schema, row_group_size=100000):
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.row_group_size = row_group_size
+        self.folder = f'{folder}/{stream}'
+        os.makedirs(self.folder, exist_ok=True)
+        parts = [
+            int(re.findall(r'part-(\d+)', filename)[0])
+            for filename in glob.glob(f'{self.folder}/part-*.parquet')
+        ]
+        self.part = max(parts, default=0) + 1
+        self.columns = {
+            name: (name, get_column_kind(field_schema))
+            for name, field_schema in json_schema.get('properties', {}).items()
+            if name != UNPARSED_COLUMN
+        }
+        arrow_types = {
+            'integer': pyarrow.int64(),
+            'number': pyarrow.float64(),
+            'boolean': pyarrow.bool_(),
+            'string': pyarrow.string(),
+            'json': pyarrow.string(),
+        }
+        self.schema = pyarrow.schema(
+            [(name, arrow_types[kind]) for name, kind in self.columns.values()] +
+            [(UNPARSED_COLUMN, pyarrow.string())]
+        )
+        self.reset_buffer()
+        self.file = None
+        self.writer = None
+
+    def reset_buffer(self):
+        self.buffer = {name: [] for name in self.schema.names}
+        self.buffer_records = 0
+
+    def write(self, data, records, offsets=None):
+        columns = list(self.columns)
+        buffer = self.buffer
+        unparsed_values = buffer[UNPARSED_COLUMN]
+        for line in bytes(data).splitlines():
+            values, unparsed = split_record(json.loads(line), self.columns)
+            for name in columns:
+                buffer[name].append(values.get(name))
+            unparsed_values.append(unparsed)
+        self.buffer_records += records
+        if self.buffer_records >= self.row_group_size:
+            self.write_row_group()
+
+    def write_row_group(self):
+        if not self.buffer_records:
+            return
+        if self.writer is None:
+            self.file = open(f'{self.folder}/part-{self.part:05d}.parquet', 'xb')
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.file, self.schema, compression='snappy')
+        table = self.pyarrow.Table.from_pydict(self.buffer, schema=self.schema)
+        self.writer.write_table(table, row_group_size=len(table))
+        self.reset_buffer()
+
+    def sync(self):
+        self.close()
+
+    def close(self):
+        self.write_row_group()
+        if self.writer is not None:
+            self.writer.close()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.writer = None
+            self.file = None
+            self.part += 1
@@ -0,0 +1,129 @@
+'''
+Sampling profiler writing the stacks of all threads as flame graph compatible folded stacks
+(one `thread;outer_function;...;inner_function count` line per stack, readable by flamegraph.pl or speedscope)
+and tracemalloc peak memory.
+
+It only uses the standard library as it is also run by connectors virtual envs python to profile connectors:
+
+    python profiler.py OUTPUT_PREFIX CONNECTOR_MAIN_PY [CONNECTOR_ARGS...]
+'''
+import os
+import sys
+import glob
+import json
+import time
+import runpy
+import threading
+import collections
+import tracemalloc
+
+
+SAMPLING_INTERVAL = 0.005
+
+
+def get_frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ',')
+
+
+class Profiler:
+    '''
+    Sample the stacks of all threads every `interval` seconds (wall clock: waiting threads are sampled too)
+    and write them into `{output_prefix}.folded`. Peak memory allocated by python is written into `{output_prefix}.memory.json`.
+    '''
+
+    def __init__(self, output_prefix, interval=SAMPLING_INTERVAL):
+        self.output_prefix = output_prefix
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+
+    def start(self):
+        tracemalloc.start()
+        self.started_at = time.monotonic()
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        threads_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self.thread.ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(get_frame_name(frame))
+                frame = frame.f_back
+            stack.append(threads_names.get(thread_id, f'thread-{thread_id}').replace(';', ','))
+            self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        write_folded_stacks(self.stacks, f'{self.output_prefix}.folded')
+        with open(f'{self.output_prefix}.memory.json', 'w', encoding='utf-8') as f:
+            json.dump({
+                'pid': os.getpid(),
+                'duration_seconds': time.monotonic() - self.started_at,
+                'samples': self.samples,
+                'tracemalloc_peak_bytes': peak_bytes,
+            }, f, indent=4)
+
+
+def write_folded_stacks(stacks, filename):
+    with open(filename, 'w', encoding='utf-8') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write(f'{stack} {count}\n')
+
+
+def merge_profiles(output_prefix, profiles_prefixes):
+    '''
+    Merge folded stacks and memory reports of `profiles_prefixes` (profiles of several processes)
+    into `{output_prefix}.folded` and `{output_prefix}.memory.json`.
+    '''
+    stacks = collections.Counter()
+    processes = {}
+    for prefix in profiles_prefixes:
+        if not os.path.exists(f'{prefix}.memory.json'):
+            continue
+        with open(f'{prefix}.folded', encoding='utf-8') as f:
+            for line in f:
+                stack, count = line.rstrip('\n').rsplit(' ', 1)
+                stacks[stack] += int(count)
+        with open(f'{prefix}.memory.json', encoding='utf-8') as f:
+            processes[os.path.basename(prefix)] = json.load(f)
+    write_folded_stacks(stacks, f'{output_prefix}.folded')
+    with open(f'{output_prefix}.memory.json', 'w', encoding='utf-8') as f:
+        json.dump({
+            'tracemalloc_peak_bytes': max([p['tracemalloc_peak_bytes'] for p in processes.values()], default=0),
+            'processes': processes,
+        }, f, indent=4)
+
+
+def get_profiles_prefixes(folder, name):
+    return sorted(filename[:-len('.memory.json')] for filename in glob.glob(f'{folder}/{name}-*.memory.json'))
+
+
+def main():
+    output_prefix, script = sys.argv[1], sys.argv[2]
+    sys.argv = sys.argv[2:]
+    # replace profiler folder (bigloader package) by the script folder as if the script was run directly
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+    profiler = Profiler(output_prefix)
+    profiler.start()
+    try:
+        runpy.run_path(script, run_name='__main__')
+    finally:
+        sys.stdout.flush()
+        profiler.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,109 +1,439 @@
 import shutil
 import re
-import io
 import zipfile
-import urllib.request
 import tempfile
 import os
 import subprocess
 import json
+import hashlib
+import functools
 import platform
+import time
+import threading
 import pathlib
 import venv
-import shutil
 import sys
+import uuid
+import glob
+import site
+import sysconfig
+import logging
+import importlib
+import collections
 
-import yaml
-import airbyte_cdk.models
-
-from . import airbyte_utils
-from .utils import print_success, print_info, print_command, print_warning, handle_error
+from . import profiler
+from .utils import print_success, print_info, print_command, print_warning, handle_error, write_json_atomically, CACHE_FOLDER
 
 
 AIRBYTE_CONNECTORS_FOLDER = 'airbyte_connectors'
 VIRTUAL_ENVS_FOLDER = '.venv'
+SHARED_VIRTUAL_ENVS_FOLDER = f'{VIRTUAL_ENVS_FOLDER}/_shared'
+SHARED_VIRTUAL_ENV_REQUIREMENTS_FILE = 'bigloader_requirements.txt'
+AIRBYTE_ARCHIVES_FOLDER = f'{CACHE_FOLDER}/airbyte_archives'
+AIRBYTE_ARCHIVE_URL = 'https://github.com/airbytehq/airbyte/zipball/{airbyte_release}'
+AIRBYTE_SOURCES_INDEX_FILE = f'{CACHE_FOLDER}/airbyte_sources_index.json'
+WHEELS_FOLDER = f'{CACHE_FOLDER}/wheels'
+BUILD_REQUIREMENTS = ['setuptools', 'wheel']
+MASTER_INDEX_MAX_AGE = 24 * 3600
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+PARALLEL_READ_QUEUE_SIZE = 10000
+PARALLEL_READ_QUEUE_BYTES_MAX = 64 * 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+PIPE_SIZE = 1024 * 1024
+STDERR_LINES_MAX = 10000
 PYTHON_FOLDER = {'Linux': 'bin', 'Darwin': 'bin', 'Windows': 'Scripts'}[platform.system()]
+SITE_PACKAGES_FOLDERS = ['lib/python*/site-packages', 'Lib/site-packages']
+AIRBYTE_LOG_LEVELS = {'CRITICAL': 'FATAL', 'WARNING': 'WARN'}
+
+
+def iter_lines(file, chunk_size=READ_CHUNK_SIZE):
+    '''
+    Yield non-empty lines (without line ending) of binary `file` read by chunks of up to `chunk_size` bytes.
+    '''
+    pending = []
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        if b'\n' not in chunk:
+            pending.append(chunk)
+            continue
+        lines = chunk.split(b'\n')
+        if pending:
+            pending.append(lines[0])
+            lines[0] = b''.join(pending)
+        pending = [lines.pop()]
+        for line in lines:
+            if line:
+                yield line
+    line = b''.join(pending)
+    if line:
+        yield line
+
+
+def increase_pipe_size(file, size=PIPE_SIZE):
+    try:
+        import fcntl
+        fcntl.fcntl(file.fileno(), getattr(fcntl, 'F_SETPIPE_SZ', 1031), size)
+    except (ImportError, OSError):
+        pass
+
+
+def drain_lines(file, lines, last_lines):
+    for line in iter_lines(file):
+        line = line.decode('utf-8', errors='replace').rstrip()
+        lines.append(line)
+        last_lines.append(line)
+
+
+def kill_on_stop(process, stop_event):
+    stop_event.wait()
+    if process.poll() is None:
+        process.kill()
+
+
+def create_log_message(level, message):
+    import airbyte_cdk.models
+    return airbyte_cdk.models.AirbyteMessage(
+        type=airbyte_cdk.models.Type.LOG,
+        log=airbyte_cdk.models.AirbyteLogMessage(level=level, message=message),
+    )
+
+
+class MessagesQueue:
+    '''
+    Queue of messages bounded by their number and their total size:
+    `put` blocks while the queue is full, which in turn blocks connectors when their stdout pipe is full.
+    '''
+
+    def __init__(self, size_max=PARALLEL_READ_QUEUE_SIZE, bytes_max=PARALLEL_READ_QUEUE_BYTES_MAX):
+        self.size_max = size_max
+        self.bytes_max = bytes_max
+        self.messages = collections.deque()
+        self.bytes = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, message, size=0):
+        '''
+        Return the number of seconds waited for space in the queue.
+        Messages put once the queue is closed are dropped.
+        '''
+        waited = 0
+        with self.condition:
+            while not self.closed and self.messages and (len(self.messages) >= self.size_max or self.bytes + size > self.bytes_max):
+                waiting_since = time.perf_counter()
+                self.condition.wait()
+                waited += time.perf_counter() - waiting_since
+            if self.closed:
+                return waited
+            self.messages.append((message, size))
+            self.bytes += size
+            self.condition.notify_all()
+        return waited
+
+    def get(self):
+        with self.condition:
+            while not self.messages:
+                self.condition.wait()
+            message, size = self.messages.popleft()
+            self.bytes -= size
+            self.condition.notify_all()
+            return message
 
+    def close(self):
+        '''
+        Release blocked `put` calls, when messages are not consumed anymore.
+        '''
+        with self.condition:
+            self.closed = True
+            self.messages.clear()
+            self.bytes = 0
+            self.condition.notify_all()
 
-def create_virtual_env(virtual_env_folder):
+
+class LogMessagesHandler(logging.Handler):
+    '''
+    Store log records of an in-process connector as airbyte LOG messages into `messages` deque.
+    '''
+
+    def __init__(self, messages):
+        super().__init__()
+        self.messages = messages
+
+    def emit(self, record):
+        try:
+            level = AIRBYTE_LOG_LEVELS.get(record.levelname, record.levelname)
+            self.messages.append(create_log_message(level, record.getMessage()))
+        except Exception:
+            self.handleError(record)
+
+
+def get_site_packages_folders(virtual_env_folder):
+    return [
+        folder
+        for pattern in SITE_PACKAGES_FOLDERS
+        for folder in glob.glob(f'{virtual_env_folder}/{pattern}')
+    ]
+
+
+def run_pip(python_exe, args, wheelhouses=(), offline=False):
+    '''
+    Run pip `args` with `python_exe`, looking for packages in the wheel cache and `wheelhouses` folders first.
+    If `offline`, packages are only looked for in these folders (no package index).
+    '''
+    command = [python_exe, '-m', 'pip', *args, '--disable-pip-version-check']
+    for wheelhouse in [WHEELS_FOLDER, *wheelhouses]:
+        command += ['--find-links', os.path.abspath(wheelhouse)]
+    if offline:
+        command.append('--no-index')
+    print_command(' '.join(command))
+    if subprocess.run(command).returncode != 0:
+        handle_error('Could not install package')
+
+
+def normalize_package_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def resolve_requirements(folder, wheelhouses=(), offline=False):
+    '''
+    Return the pinned requirements (`name==version`) of the dependencies of python package located at `folder`,
+    as resolved by pip for bigloader python (without the package itself).
+    '''
+    os.makedirs(WHEELS_FOLDER, exist_ok=True)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        report_file = f'{temp_dir}/report.json'
+        args = ['install', '--dry-run', '--ignore-installed', '--quiet', '--report', report_file, folder]
+        run_pip(sys.executable, args, wheelhouses=wheelhouses, offline=offline)
+        report = json.load(open(report_file, encoding='utf-8'))
+    return sorted(
+        f'{normalize_package_name(package["metadata"]["name"])}=={package["metadata"]["version"]}'
+        for package in report['install']
+        if 'dir_info' not in package['download_info']
+    )
+
+
+def create_virtual_env(virtual_env_folder, with_pip=True):
     print_info(f'Creating virtual env at {virtual_env_folder}')
     if os.path.exists(virtual_env_folder):
         shutil.rmtree(virtual_env_folder)
-    venv.create(virtual_env_folder, with_pip=True)
+    venv.create(virtual_env_folder, with_pip=with_pip, symlinks=os.name != 'nt')
+
+
+def get_shared_virtual_env(requirements, wheelhouses=(), offline=False):
+    '''
+    Return the shared virtual env folder where pinned `requirements` are installed, creating it if needed.
 
+    Shared virtual envs are content-addressed: their folder name is a hash of python version, platform and `requirements`
+    so that connectors with the same dependencies share the same virtual env.
+    Requirements are first built as wheels into the wheel cache, then installed from it.
+    A shared virtual env is complete once its requirements file is written (last step).
+    '''
+    key = hash_json({
+        'python': sys.implementation.cache_tag,
+        'platform': sysconfig.get_platform(),
+        'requirements': requirements,
+    })
+    virtual_env_folder = f'{SHARED_VIRTUAL_ENVS_FOLDER}/{key[:16]}'
+    requirements_file = f'{virtual_env_folder}/{SHARED_VIRTUAL_ENV_REQUIREMENTS_FILE}'
+    if os.path.exists(requirements_file):
+        print_info(f'Using shared virtual env {virtual_env_folder}')
+        return virtual_env_folder
+    create_virtual_env(virtual_env_folder)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        requirements_to_install_file = f'{temp_dir}/requirements.txt'
+        with open(requirements_to_install_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(requirements) + '\n')
+        args = ['wheel', '--quiet', '--wheel-dir', os.path.abspath(WHEELS_FOLDER), '-r', requirements_to_install_file, *BUILD_REQUIREMENTS]
+        run_pip(sys.executable, args, wheelhouses=wheelhouses, offline=offline)
+        python_exe = str(pathlib.Path(f'{virtual_env_folder}/{PYTHON_FOLDER}/python'))
+        args = ['install', '--quiet', '--no-deps', '-r', requirements_to_install_file]
+        run_pip(python_exe, args, offline=True)
+    with open(requirements_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(requirements) + '\n')
+    return virtual_env_folder
 
+
+def create_layered_virtual_env(virtual_env_folder, shared_virtual_env_folder, package_folder):
+    '''
+    Create a virtual env without pip nor packages whose site-packages add the ones of `shared_virtual_env_folder`
+    and `package_folder` (as `pip install -e` would) through a `.pth` file.
+    '''
+    create_virtual_env(virtual_env_folder, with_pip=False)
+    lines = [
+        f'import site; site.addsitedir({os.path.abspath(folder)!r})'
+        for folder in get_site_packages_folders(shared_virtual_env_folder)
+    ]
+    lines.append(os.path.abspath(package_folder))
+    site_packages_folder = get_site_packages_folders(virtual_env_folder)[0]
+    with open(f'{site_packages_folder}/bigloader_layers.pth', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def hash_folder(folder, excluded_files=()):
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__' and not d.endswith('.egg-info'))
+        for file in sorted(files):
+            path = os.path.relpath(os.path.join(root, file), folder).replace('\\', '/')
+            if path in excluded_files:
+                continue
+            digest.update(path.encode('utf-8'))
+            with open(os.path.join(root, file), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def hash_json(content):
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+@functools.lru_cache()
 def download_airbyte_code_from_github(airbyte_release='master'):
-    print_info(f'Downloading airbyte GitHub repo as a zip archive')
-    url = f'https://github.com/airbytehq/airbyte/zipball/{airbyte_release}'
-    resp = urllib.request.urlopen(url)
-    return zipfile.ZipFile(io.BytesIO(resp.read()))
+    '''
+    Return airbyte GitHub repo of `airbyte_release` as a zip archive stored in cache folder.
+    Archives of releases are downloaded only once, `master` archive is downloaded once per process.
+    '''
+    filename = f'{AIRBYTE_ARCHIVES_FOLDER}/{airbyte_release.replace("/", "_")}.zip'
+    if airbyte_release == 'master' or not os.path.exists(filename):
+        import urllib.request
+        print_info(f'Downloading airbyte GitHub repo as a zip archive into {filename}')
+        os.makedirs(AIRBYTE_ARCHIVES_FOLDER, exist_ok=True)
+        url = AIRBYTE_ARCHIVE_URL.format(airbyte_release=airbyte_release)
+        with tempfile.NamedTemporaryFile('wb', dir=AIRBYTE_ARCHIVES_FOLDER, delete=False) as f:
+            try:
+                with urllib.request.urlopen(url) as resp:
+                    shutil.copyfileobj(resp, f, DOWNLOAD_CHUNK_SIZE)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+        os.replace(f.name, filename)
+    else:
+        print_info(f'Using cached airbyte GitHub repo zip archive {filename}')
+    return zipfile.ZipFile(filename)
+
+
+def extract_folder_from_archive(archive, archive_folder, folder):
+    for member in archive.infolist():
+        if member.is_dir() or not member.filename.startswith(archive_folder):
+            continue
+        filename = f'{folder}/{member.filename[len(archive_folder):]}'
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with archive.open(member) as src, open(filename, 'wb') as dst:
+            shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+
+
+def build_python_airbyte_sources_index(airbyte_archive):
+    pattern = re.compile(r'(.*airbyte-integrations/connectors/(source-[\w-]+)/)setup\.py')
+    index = {}
+    for path in airbyte_archive.namelist():
+        match = pattern.fullmatch(path)
+        if match:
+            index[match.group(2)] = {'folder': match.group(1), 'setup_file': path}
+    return index
+
+
+def get_python_airbyte_sources_index(airbyte_release='master', refresh=False):
+    '''
+    Return python airbyte sources of `airbyte_release` as `{source: {'folder': ..., 'setup_file': ...}}`
+    with paths relative to the zip archive root.
+    Indexes of all requested releases are stored in one cache file: a release is indexed once from its archive,
+    except `master` which is indexed again when older than `MASTER_INDEX_MAX_AGE` seconds.
+    '''
+    index = {}
+    if os.path.exists(AIRBYTE_SOURCES_INDEX_FILE):
+        index = json.load(open(AIRBYTE_SOURCES_INDEX_FILE, encoding='utf-8'))
+    release_index = index.get(airbyte_release)
+    is_outdated = (
+        release_index is None or
+        (airbyte_release == 'master' and time.time() - release_index['indexed_at'] > MASTER_INDEX_MAX_AGE)
+    )
+    if refresh or is_outdated:
+        airbyte_archive = download_airbyte_code_from_github(airbyte_release=airbyte_release)
+        print_info(f'Indexing python airbyte sources of release {airbyte_release}')
+        release_index = {
+            'indexed_at': time.time(),
+            'sources': build_python_airbyte_sources_index(airbyte_archive),
+        }
+        index[airbyte_release] = release_index
+        write_json_atomically(index, AIRBYTE_SOURCES_INDEX_FILE)
+    return release_index['sources']
 
 
 def list_python_airbyte_sources(airbyte_release='master'):
-    airbyte_archive = download_airbyte_code_from_github(airbyte_release=airbyte_release)
-    print_info('Listing connectors in airbyte code starting with `source-` and having a `setup.py` file')
-    pattern = r'airbyte-integrations/connectors/source-([\w-]+)/setup.py'
-    return [
-        'source-' + re.findall(pattern, path)[0]
-        for path in airbyte_archive.namelist()
-        if re.findall(pattern, path)
-    ]
+    return list(get_python_airbyte_sources_index(airbyte_release=airbyte_release))
 
 
 def check_airbyte_source_exists_and_is_a_python_connector(airbyte_source, airbyte_release='master'):
-    url = f'https://api.github.com/repos/airbytehq/airbyte/contents/airbyte-integrations/connectors/{airbyte_source}/setup.py'
-    try:
-        urllib.request.urlopen(url)
-    except:
+    sources_index = get_python_airbyte_sources_index(airbyte_release=airbyte_release)
+    if airbyte_source not in sources_index and airbyte_release == 'master':
+        sources_index = get_python_airbyte_sources_index(airbyte_release=airbyte_release, refresh=True)
+    if airbyte_source not in sources_index:
         handle_error(f'Airbyte source `{airbyte_source}` could not be found on Airbyte GitHub repo for release {airbyte_release}. To get the full list of available airbyte sources please run `bigloader list`')
     return True
 
 
 class AirbyteSource:
 
-    def __init__(self, name):
+    def __init__(self, name, refresh_catalog=False, profile_folder=None, in_process=False):
         self.name = name
         self.folder = f'{AIRBYTE_CONNECTORS_FOLDER}/{name}'
         self.virtualenv_folder = f'{VIRTUAL_ENVS_FOLDER}/{name}'
+        self.cache_folder = f'{CACHE_FOLDER}/{name}'
         self.python_exe = str(pathlib.Path(f'{self.virtualenv_folder}/{PYTHON_FOLDER}/python'))
         self.python_command = f'{self.python_exe} {self.folder}/main.py'
         self.config_file = f'{self.folder}/bigloader_config.yaml'
+        self.refresh_catalog = refresh_catalog
+        self.profile_folder = profile_folder
+        self.profile_name = f'connector-{uuid.uuid4().hex[:8]}'
+        self.in_process = in_process
+        self.cache = {}
 
     def download(self, airbyte_release='master'):
         check_airbyte_source_exists_and_is_a_python_connector(self.name, airbyte_release=airbyte_release)
-        airbyte_archive = download_airbyte_code_from_github(airbyte_release)
-        connector_path = f'airbyte-integrations/connectors/{self.name}/'
-        connector_folder = next(path for path in airbyte_archive.namelist() if path.endswith(connector_path))
-        connector_files = [path for path in airbyte_archive.namelist() if connector_folder in path]
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            print_info('Extracting connector files from zip archive')
-            airbyte_archive.extractall(tmpdirname, members=connector_files)
-            print_info(f'Copying connector files into {self.folder}')
-            if os.path.exists(self.folder):
-                shutil.rmtree(self.folder)
-            os.makedirs(self.folder)
-            shutil.copytree(f'{tmpdirname}/{connector_folder}', self.folder, dirs_exist_ok=True)
+        connector_folder = get_python_airbyte_sources_index(airbyte_release=airbyte_release)[self.name]['folder']
+        airbyte_archive = download_airbyte_code_from_github(airbyte_release=airbyte_release)
+        print_info(f'Extracting connector files from zip archive into {self.folder}')
+        if os.path.exists(self.folder):
+            shutil.rmtree(self.folder)
+        os.makedirs(self.folder)
+        extract_folder_from_archive(airbyte_archive, connector_folder, self.folder)
         print_success(f'Successfully downloaded "{self.name}" airbyte connector into "{self.folder}" folder')
 
-    def install(self):
+    def install(self, wheelhouses=(), offline=False):
+        '''
+        Install connector in a virtual env layered on top of a shared virtual env containing its dependencies
+        (created only if no other connector has the same dependencies).
+        Packages are looked for in the wheel cache and `wheelhouses` folders first and only there if `offline`.
+        '''
         if os.path.exists(self.virtualenv_folder):
             print_warning('Airbyte connector is already installed')
             print_info(f'If you wish to reinstall it, remove the folder `{self.virtualenv_folder}` and restart this command')
             return
-        create_virtual_env(self.virtualenv_folder)
-        print_info(f'Installing airbyte connector {self.name} located at {self.folder} via pip')
-        command = f'{self.python_exe} -m pip install -e {self.folder}'
-        print_command(command)
-        result = os.system(command)
-        if result != 0:
-            handle_error('Could not install package')
-        print_success(f'Successfully installed python package located at {self.folder}')
-
-    def run(self, args, print_log=True, catalog=None):
+        print_info(f'Resolving dependencies of airbyte connector {self.name} located at {self.folder}')
+        requirements = resolve_requirements(self.folder, wheelhouses=wheelhouses, offline=offline)
+        shared_virtual_env_folder = get_shared_virtual_env(requirements, wheelhouses=wheelhouses, offline=offline)
+        create_layered_virtual_env(self.virtualenv_folder, shared_virtual_env_folder, self.folder)
+        print_success(f'Successfully installed python package located at {self.folder} on top of shared virtual env {shared_virtual_env_folder}')
+
+    def run(self, args, print_log=True, catalog=None, state=None, metrics=None, stop_event=None):
+        '''
+        Run connector `args` command in a subprocess and yield its messages.
+        stdout is read by large chunks. stderr lines are read by another thread and yielded as WARN LOG messages.
+        The connector is blocked when its stdout pipe is full, until messages are consumed.
+        If `stop_event` is set (by another thread), the connector is killed.
+        '''
+        import airbyte_cdk.models
+        from .messages import decode_message
         if not os.path.exists(os.path.dirname(self.python_exe)):
             handle_error(f'Connector is not installed. Install it with `bigloader install {self.name}`')
         with tempfile.TemporaryDirectory() as temp_dir:
             command = f'{self.python_command} {args}'
+            if self.profile_folder:
+                output_prefix = f'{self.profile_folder}/{self.profile_name}-{args.split()[0]}-{uuid.uuid4().hex[:8]}'
+                command = f'{self.python_exe} {profiler.__file__} {output_prefix} {self.folder}/main.py {args}'
             needs_config = 'spec' not in args
             if needs_config:
                 filename = f'{temp_dir}/config.json'
@@ -113,20 +443,193 @@ class AirbyteSource:
                 filename = f'{temp_dir}/catalog.json'
                 json.dump(catalog, open(filename, 'w', encoding='utf-8'))
                 command += f' --catalog {filename}'
+            if state:
+                filename = f'{temp_dir}/state.json'
+                json.dump(state, open(filename, 'w', encoding='utf-8'))
+                command += f' --state {filename}'
             print_command(command)
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-            for line in iter(process.stdout.readline, b""):
-                try:
-                    message = airbyte_cdk.models.AirbyteMessage.parse_raw(line)
-                except:
-                    print_info(line.decode().strip())
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, bufsize=0)
+            increase_pipe_size(process.stdout)
+            stderr_lines = collections.deque(maxlen=STDERR_LINES_MAX)
+            last_stderr_lines = collections.deque(maxlen=20)
+            stderr_thread = threading.Thread(target=drain_lines, args=(process.stderr, stderr_lines, last_stderr_lines), daemon=True)
+            stderr_thread.start()
+            if stop_event is not None:
+                threading.Thread(target=kill_on_stop, args=(process, stop_event), daemon=True).start()
+            try:
+                for line in iter_lines(process.stdout):
+                    if stderr_lines:
+                        yield from self.get_stderr_messages(stderr_lines, print_log)
+                    if metrics is None:
+                        message = decode_message(line)
+                    else:
+                        parse_started_at = time.perf_counter()
+                        message = decode_message(line)
+                        is_record = message is not None and message.type == airbyte_cdk.models.Type.RECORD
+                        metrics.add_parse_time(message.record.stream if is_record else None, time.perf_counter() - parse_started_at)
+                    if message is None:
+                        print_info(line.decode('utf-8', errors='replace').strip())
+                        continue
+                    message = self.filter_message(message, print_log)
+                    if message is not None:
+                        yield message
+                stderr_thread.join()
+                yield from self.get_stderr_messages(stderr_lines, print_log)
+                return_code = process.wait()
+                if return_code != 0 and not (stop_event is not None and stop_event.is_set()):
+                    error = '\n'.join(last_stderr_lines)
+                    handle_error(f'Connector `{args.split()[0]}` command failed with exit code {return_code}\n{error}', exit_code=return_code if return_code > 0 else 1)
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+
+    def get_stderr_messages(self, stderr_lines, print_log):
+        while stderr_lines:
+            message = self.filter_message(create_log_message('WARN', stderr_lines.popleft()), print_log)
+            if message is not None:
+                yield message
+
+    def filter_message(self, message, print_log):
+        import airbyte_cdk.models
+        if (message.type == airbyte_cdk.models.Type.LOG) and print_log:
+            print_info(message.log.json(exclude_unset=True))
+        elif message.type == airbyte_cdk.models.Type.TRACE:
+            handle_error(message.trace.error.message)
+        else:
+            return message
+
+    @functools.cached_property
+    def source(self):
+        '''
+        Connector source instance imported from the connector virtual env site-packages (appended to `sys.path`).
+        Packages already imported by bigloader (airbyte_cdk, pydantic, ...) are shared with the connector.
+        '''
+        site_packages_folders = get_site_packages_folders(self.virtualenv_folder)
+        if not site_packages_folders:
+            handle_error(f'Connector is not installed. Install it with `bigloader install {self.name}`')
+        version = f'python{sys.version_info.major}.{sys.version_info.minor}'
+        if platform.system() != 'Windows' and not any(f'/{version}/' in folder for folder in site_packages_folders):
+            print_warning(f'Connector virtual env was not created with {version}: running it in-process may fail')
+        for folder in site_packages_folders:
+            site.addsitedir(os.path.abspath(folder))
+        sys.path.append(os.path.abspath(self.folder))
+        package = importlib.import_module(self.name.replace('-', '_'))
+        SourceClass = getattr(package, self.name.replace('-', ' ').title().replace(' ', ''))
+        return SourceClass()
+
+    def run_in_process(self, catalog, state=None, print_log=True):
+        '''
+        Run `read` command by calling the connector source in this process:
+        messages are yielded as `AirbyteMessage` objects, without any serialization.
+        Connector logs are yielded as LOG messages.
+        '''
+        source = self.source
+        logger = logging.getLogger('airbyte')
+        logger.setLevel(logging.INFO)
+        log_messages = collections.deque()
+        handler = LogMessagesHandler(log_messages)
+        logger.addHandler(handler)
+        propagate, logger.propagate = logger.propagate, False
+        try:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                config = source.configure(self.config, temp_dir)
+                filename = f'{temp_dir}/catalog.json'
+                json.dump(catalog, open(filename, 'w', encoding='utf-8'))
+                configured_catalog = source.read_catalog(filename)
+                filename = None
+                if state:
+                    filename = f'{temp_dir}/state.json'
+                    json.dump(state, open(filename, 'w', encoding='utf-8'))
+                state = source.read_state(filename)
+                for message in source.read(logger, config, configured_catalog, state):
+                    while log_messages:
+                        log_message = self.filter_message(log_messages.popleft(), print_log)
+                        if log_message is not None:
+                            yield log_message
+                    message = self.filter_message(message, print_log)
+                    if message is not None:
+                        yield message
+                while log_messages:
+                    log_message = self.filter_message(log_messages.popleft(), print_log)
+                    if log_message is not None:
+                        yield log_message
+        finally:
+            logger.removeHandler(handler)
+            logger.propagate = propagate
+
+    def read(self, catalog, state=None, print_log=True, parallel=1, metrics=None):
+        '''
+        Run `read` command on `catalog` streams split into `parallel` groups, each one read by its own connector process.
+        Messages of all groups are merged into one iterator: records of a stream keep their order
+        and each STATE message holds the latest state of every group.
+        If the consumer stops early (error or iterator closed), reader threads are released and connectors are killed.
+        '''
+        import airbyte_cdk.models
+        if self.in_process and parallel > 1:
+            raise ValueError('In-process connectors cannot read streams in parallel')
+        groups = [catalog['streams'][k::parallel] for k in range(parallel)]
+        groups = [group for group in groups if group]
+        if len(groups) <= 1:
+            yield from self.run_read(catalog, state=state, print_log=print_log, metrics=metrics)
+            return
+        state = state or {}
+        messages_queue = MessagesQueue()
+        stop_event = threading.Event()
+        groups_states = {}
+
+        def read_group(group, group_catalog, group_state):
+            waited = 0
+            messages = self.run_read(group_catalog, state=group_state, print_log=print_log, metrics=metrics, stop_event=stop_event)
+            try:
+                for message in messages:
+                    waited += messages_queue.put((group, message), size=len(getattr(message, 'line', None) or ''))
+                    if stop_event.is_set():
+                        break
+                if metrics:
+                    metrics.observe('read_blocked_seconds', f'group-{group}', waited)
+            except BaseException as e:
+                messages_queue.put((group, e))
+            finally:
+                messages.close()
+            messages_queue.put((group, None))
+
+        for group, streams in enumerate(groups):
+            group_catalog = {**catalog, 'streams': streams}
+            group_state = state
+            if isinstance(state, dict):
+                names = [stream['stream']['name'] for stream in streams]
+                group_state = {name: value for name, value in state.items() if name in names}
+                groups_states[group] = group_state
+            threading.Thread(target=read_group, args=(group, group_catalog, group_state), daemon=True).start()
+
+        running_groups = len(groups)
+        try:
+            while running_groups:
+                group, message = messages_queue.get()
+                if message is None:
+                    running_groups -= 1
                     continue
-                if (message.type == airbyte_cdk.models.Type.LOG) and print_log:
-                    print_info(message.log.json(exclude_unset=True))
-                elif message.type == airbyte_cdk.models.Type.TRACE:
-                    handle_error(message.trace.error.message)
-                else:
-                    yield message
+                if isinstance(message, BaseException):
+                    raise message
+                if message.type == airbyte_cdk.models.Type.STATE and isinstance(message.state.data, dict) and isinstance(state, dict):
+                    groups_states[group] = message.state.data
+                    merged_state = dict(state)
+                    for group_state in groups_states.values():
+                        merged_state.update(group_state)
+                    message = airbyte_cdk.models.AirbyteMessage(
+                        type=airbyte_cdk.models.Type.STATE,
+                        state=airbyte_cdk.models.AirbyteStateMessage(data=merged_state),
+                    )
+                yield message
+        finally:
+            stop_event.set()
+            messages_queue.close()
+
+    def run_read(self, catalog, state=None, print_log=True, metrics=None, stop_event=None):
+        if self.in_process:
+            return self.run_in_process(catalog, state=state, print_log=print_log)
+        return self.run('read', print_log=print_log, catalog=catalog, state=state, metrics=metrics, stop_event=stop_event)
 
     def run_and_return_first_message(self, command):
         messages = self.run(command)
@@ -145,14 +648,36 @@ class AirbyteSource:
             spec = self.spec
         except:
             handle_error('Could not instanciate connector and get spec')
+        from . import airbyte_utils
         yaml_config = airbyte_utils.generate_connection_yaml_config_sample(spec)
         with open(self.config_file, 'w', encoding='utf-8') as out:
             out.write(yaml_config)
         print_success(f'Config file as been successfully written at `{self.config_file}`')
         print_warning('PLEASE make desired changes to this configuration file before running connector!')
 
+    @functools.cached_property
+    def folder_hash(self):
+        return hash_folder(self.folder, excluded_files=[os.path.basename(self.config_file)])
+
+    def get_cached(self, name, compute, config=None):
+        '''
+        Return `compute()` result cached in memory and on disk.
+        Cache key depends on connector folder contents and on `config`.
+        Disk cache is ignored (and overwritten) when `refresh_catalog` is set.
+        '''
+        key = hash_json([self.folder_hash, config])[:16]
+        filename = f'{self.cache_folder}/{name}_{key}.json'
+        if filename not in self.cache:
+            if os.path.exists(filename) and not self.refresh_catalog:
+                self.cache[filename] = json.load(open(filename, encoding='utf-8'))
+            else:
+                self.cache[filename] = compute()
+                write_json_atomically(self.cache[filename], filename)
+        return self.cache[filename]
+
     @property
     def config(self):
+        import yaml
         if not os.path.exists(self.folder):
             handle_error(f'Connector does nos exists: could not find folder `{self.folder}`. Download connector from Airbyte Github with command `bigloader get {self.name}` or create an airbyte connector yourself in that folder')
         if not os.path.exists(self.config_file):
@@ -161,17 +686,28 @@ class AirbyteSource:
 
     @property
     def spec(self):
-        message = self.run_and_return_first_message('spec')
-        return message.spec.dict(exclude_unset=True)
+        def get_spec():
+            message = self.run_and_return_first_message('spec')
+            return json.loads(message.spec.json(exclude_unset=True))
+        return self.get_cached('spec', get_spec)
 
     @property
     def catalog(self):
-        message = self.run_and_return_first_message('discover')
-        return json.loads(message.catalog.json(exclude_unset=True))
+        def discover():
+            message = self.run_and_return_first_message('discover')
+            return json.loads(message.catalog.json(exclude_unset=True))
+        return self.get_cached('catalog', discover, config=self.config)
 
     @property
     def configured_catalog(self):
-        catalog = self.catalog
+        return self.get_configured_catalog()
+
+    def get_configured_catalog(self, destination_sync_mode='append'):
+        '''
+        With `append_dedup` destination sync mode, streams with a `source_defined_primary_key` are deduplicated
+        on this primary key by destinations which support it. Other streams are appended.
+        '''
+        catalog = dict(self.catalog)
         catalog['streams'] = [
             {
                 "stream": stream,
@@ -181,6 +717,11 @@ class AirbyteSource:
             }
             for stream in catalog['streams']
         ]
+        if destination_sync_mode == 'append_dedup':
+            for stream in catalog['streams']:
+                if stream['stream'].get('source_defined_primary_key'):
+                    stream['destination_sync_mode'] = 'append_dedup'
+                    stream['primary_key'] = stream['stream']['source_defined_primary_key']
         return catalog
 
     @property
@@ -1,8 +1,14 @@
+import os
 import sys
+import json
+import tempfile
 
 import click
 
 
+CACHE_FOLDER = '.bigloader_cache'
+
+
 def print_color(msg):
     click.echo(click.style(msg, fg='cyan'))
 
@@ -23,9 +29,9 @@ def print_warning(msg):
     click.echo(click.style(f'WARNING: {msg}', fg='cyan'))
 
 
-def handle_error(msg):
+def handle_error(msg, exit_code=1):
     click.echo(click.style(f'ERROR: {msg}', fg='red'))
-    sys.exit()
+    sys.exit(exit_code)
 
 
 def to_camelcase(snake_case_string):
@@ -33,3 +39,27 @@ def to_camelcase(snake_case_string):
         word.title() if k != 0 else word
         for k, word in enumerate(snake_case_string.split('_'))
     )
+
+
+def read_json(filename, default=None):
+    if not os.path.exists(filename):
+        return default
+    with open(filename, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_file_atomically(content, filename):
+    '''
+    Write `content` string into a temporary file which then replaces `filename`:
+    readers never see a partially written file, even after a crash.
+    '''
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(filename) or '.', delete=False) as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f.name, filename)
+
+
+def write_json_atomically(content, filename):
+    write_file_atomically(json.dumps(content), filename)
@@ -14,6 +14,10 @@ setup(
         'airbyte-cdk',
         'google-cloud-bigquery',
     ],
+    extras_require={
+        'parquet': ['pyarrow'],
+        'zstd': ['zstandard'],
+    },
     entry_points={
         'console_scripts': [
             'bigloader = bigloader.cli:cli',
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+import airbyte_cdk.models
+
+from benchmarks import fake_bigquery
+from bigloader import destinations
+from bigloader.messages import RecordBatch
+
+
+CATALOG = {'streams': [{'stream': {'name': 'users'}}]}
+
+
+@pytest.fixture(autouse=True)
+def fake_client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fake_bigquery.patch_bigquery_client()
+    fake_bigquery.FakeBigQueryClient.reset()
+    yield fake_bigquery.FakeBigQueryClient
+    fake_bigquery.FakeBigQueryClient.reset()
+
+
+def create_state_message(data):
+    return airbyte_cdk.models.AirbyteMessage(
+        type=airbyte_cdk.models.Type.STATE,
+        state=airbyte_cdk.models.AirbyteStateMessage(data=data),
+    )
+
+
+def create_batch(stream, records):
+    batch = RecordBatch(stream)
+    for record in records:
+        batch.append(json.dumps(record))
+    return batch
+
+
+def run(batches):
+    destination = destinations.create_destination('bigquery(dataset)', CATALOG)
+    destination.run_batches(batches)
+
+
+def test_get_state_returns_last_checkpoint(fake_client):
+    run([
+        create_batch('users', [{'id': 1}]),
+        create_state_message({'users': {'cursor': 1}}),
+        create_batch('users', [{'id': 2}]),
+        create_state_message({'users': {'cursor': 2}}),
+    ])
+    merged_state = fake_client.states['dataset._airbyte_latest_state']
+    assert json.loads(merged_state) == {'data': {'users': {'cursor': 2}}}
+    assert fake_client.rows['dataset._airbyte_raw_users'] == 2
+    assert destinations.create_destination('bigquery(dataset)', CATALOG).get_state() == {'users': {'cursor': 2}}
+
+
+def test_get_state_falls_back_to_states_table_when_latest_state_table_is_empty(fake_client):
+    run([
+        create_state_message({'users': {'cursor': 1}}),
+        create_state_message({'users': {'cursor': 3}}),
+    ])
+    del fake_client.states['dataset._airbyte_latest_state']
+    assert destinations.create_destination('bigquery(dataset)', CATALOG).get_state() == {'users': {'cursor': 3}}
+
+
+def test_get_state_without_checkpoint():
+    assert destinations.create_destination('bigquery(dataset)', CATALOG).get_state() == {}